@@ -1,17 +1,46 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, Response
 from flask_httpauth import HTTPBasicAuth
 from flask_cors import CORS
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, select, text, MetaData, Table
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.types import NullType
 from langchain_community.utilities import SQLDatabase
+from langchain_community.utilities.sql_database import truncate_word
+from langchain_community.tools.sql_database.prompt import QUERY_CHECKER
+from langchain_core.prompts import PromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
 from dotenv import load_dotenv
 import os
-from langchain_openai import OpenAI
+from langchain_openai import OpenAI, AzureOpenAI, ChatOpenAI, AzureChatOpenAI
+import openai
 from langchain_experimental.sql import SQLDatabaseChain
+from langchain_community.callbacks import get_openai_callback
 import ast
 from loguru import logger
 import threading
 import sys 
+import re
+import time
+import sqlite3
+import json
+import queue
+import hashlib
+import math
+import zlib
+import heapq
+import itertools
+import hmac
+import base64
+import csv
+import io
+import datetime
+import decimal
+import random
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 
 load_dotenv()
 
@@ -35,7 +64,7 @@ users = {
 def verify_password(username, password):
     if username in users and password == users[username]:
         logger.info(f"User {username} authenticated successfully.")
-        return True
+        return username
     logger.warning(f"Failed authentication attempt for user {username}.")
     return False
 
@@ -49,24 +78,262 @@ DATABASE = os.getenv('DATABASE')
 USERNAME = os.getenv('USERNAME')
 PASSWORD = os.getenv('PASSWORD')
 API_KEY = os.getenv('OPENAI_API_KEY')
+DATABASE_URL = os.getenv('DATABASE_URL')
 include_tables_str = os.getenv('INCLUDE_TABLES')
 INCLUDE_TABLES = ast.literal_eval(include_tables_str) if include_tables_str else []
 openai_api_version = os.getenv('AZURE_OPENAI_API_VERSION')
 azure_deployment = os.getenv('AZURE_OPENAI_CHAT_DEPLOYMENT_NAME')
+azure_endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
+azure_api_key = os.getenv('AZURE_OPENAI_API_KEY')
+llm_backends_str = os.getenv('LLM_BACKENDS')
+LLM_BACKENDS = ast.literal_eval(llm_backends_str) if llm_backends_str else []
 
-if not all([SERVER, DATABASE, USERNAME, PASSWORD, API_KEY]):
+if not (API_KEY or LLM_BACKENDS) or not (DATABASE_URL or all([SERVER, DATABASE, USERNAME, PASSWORD])):
     logger.warning("Missing required environment variables.")
     raise ValueError("Please set all environment variables: SERVER, DATABASE, USERNAME, PASSWORD, API_KEY")
 
-url = f"mssql+pyodbc:///?odbc_connect=Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:{SERVER},1433;Database={DATABASE};Uid={USERNAME};Pwd={PASSWORD};MARS_Connection=Yes;"
-url += "Connection Timeout=30;"
+if DATABASE_URL:
+    # Points the service at a stand-in database, e.g. the SQLite copy used by benchmark.py.
+    url = DATABASE_URL
+else:
+    url = f"mssql+pyodbc:///?odbc_connect=Driver={{ODBC Driver 17 for SQL Server}};Server=tcp:{SERVER},1433;Database={DATABASE};Uid={USERNAME};Pwd={PASSWORD};MARS_Connection=Yes;"
+    url += "Connection Timeout=30;"
+
+LLM_HEDGING = os.getenv('LLM_HEDGING', 'false').lower() in ('1', 'true', 'yes')
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '2.0'))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+LLM_COOLDOWN = float(os.getenv('LLM_COOLDOWN', '10'))
+LLM_LATENCY_WINDOW = int(os.getenv('LLM_LATENCY_WINDOW', '200'))
 
-llm = OpenAI(openai_api_key=API_KEY)
+def llm_text(output):
+    return output if isinstance(output, str) else output.content
+
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return LLM_COOLDOWN
+
+class LLMBackend:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.outstanding = 0
+        self.cooldown_until = 0.0
+        self.latencies = []
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def cooling_down(self):
+        return time.monotonic() < self.cooldown_until
+
+    def latency_p95(self):
+        if len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+class LLMPool:
+    def __init__(self, backends):
+        self.backends = backends
+        self.lock = threading.Lock()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv('LLM_HEDGE_WORKERS', '40')), thread_name_prefix='llm-hedge')
+
+    def pick(self, exclude=()):
+        with self.lock:
+            candidates = [backend for backend in self.backends if backend not in exclude]
+            if not candidates:
+                return None
+            available = [backend for backend in candidates if not backend.cooling_down()]
+            if available:
+                # Least outstanding requests first; random ties keep idle backends evenly used.
+                backend = min(available, key=lambda backend: (backend.outstanding, random.random()))
+            else:
+                backend = min(candidates, key=lambda backend: backend.cooldown_until)
+            backend.outstanding += 1
+            return backend
+
+    def finish(self, backend, started, error=None):
+        seconds = time.perf_counter() - started
+        throttled = isinstance(error, openai.RateLimitError)
+        with self.lock:
+            backend.outstanding -= 1
+            backend.calls += 1
+            if error is None:
+                backend.latencies.append(seconds)
+                del backend.latencies[:-LLM_LATENCY_WINDOW]
+            elif throttled:
+                backend.throttled += 1
+                backend.cooldown_until = time.monotonic() + retry_after(error)
+            else:
+                backend.errors += 1
+        metrics.inc('llm_backend_requests_total', backend=backend.name, outcome='ok' if error is None else 'throttled' if throttled else 'error')
+        if error is None:
+            metrics.observe('llm_backend_seconds', seconds, backend=backend.name)
+
+    def call(self, backend, prompt, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = llm_text(backend.client.invoke(prompt, **kwargs))
+        except Exception as e:
+            self.finish(backend, started, e)
+            raise
+        self.finish(backend, started)
+        return result
+
+    def failover(self, error):
+        # Throttling, dropped connections and server errors are worth another backend; a bad request is not.
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    def next_attempt(self, tried, error, kwargs):
+        # Clients never retry on their own: untried backends go first, then up to LLM_MAX_RETRIES more rounds after a
+        # backoff, and each attempt's timeout is only what is left of the request deadline.
+        position = len(tried) % len(self.backends)
+        if tried and not position:
+            retry = len(tried) // len(self.backends)
+            if retry > LLM_MAX_RETRIES:
+                raise error
+            left = time_left()
+            backoff = LLM_RETRY_BACKOFF * 2 ** (retry - 1)
+            time.sleep(backoff if left is None else min(backoff, left))
+        timeout = time_left()
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        backend = self.pick(tried[len(tried) - position:])
+        tried.append(backend)
+        return backend
+
+    def invoke(self, prompt, **kwargs):
+        tried = []
+        error = None
+        while True:
+            backend = self.next_attempt(tried, error, kwargs)
+            try:
+                if LLM_HEDGING and len(self.backends) > 1:
+                    return self.hedged(backend, tried, prompt, **kwargs)
+                return self.call(backend, prompt, **kwargs)
+            except Exception as e:
+                if not self.failover(e):
+                    raise
+                logger.warning(f"LLM backend {backend.name} failed, trying another: {first_line(e)}")
+                error = e
+
+    def hedged(self, backend, tried, prompt, **kwargs):
+        # Copying the context keeps stage labels and token counting attached to the calling request.
+        primary = self.hedge_executor.submit(contextvars.copy_context().run, self.call, backend, prompt, **kwargs)
+        try:
+            return primary.result(timeout=backend.latency_p95())
+        except FutureTimeoutError:
+            pass
+        hedge_backend = self.pick(tried)
+        if hedge_backend is None:
+            return primary.result()
+        tried.append(hedge_backend)
+        with self.lock:
+            hedge_backend.hedges += 1
+        hedge = self.hedge_executor.submit(contextvars.copy_context().run, self.call, hedge_backend, prompt, **kwargs)
+        error = None
+        for future in as_completed([primary, hedge]):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is hedge:
+                with self.lock:
+                    hedge_backend.hedges_won += 1
+            return result
+        raise error
+
+    def stream(self, prompt, **kwargs):
+        # Tokens are forwarded as they arrive, so a stream only fails over before its first token.
+        tried = []
+        error = None
+        while True:
+            backend = self.next_attempt(tried, error, kwargs)
+            started = time.perf_counter()
+            emitted = False
+            try:
+                for chunk in backend.client.stream(prompt, **kwargs):
+                    emitted = True
+                    yield llm_text(chunk)
+            except Exception as e:
+                self.finish(backend, started, e)
+                if emitted or not self.failover(e):
+                    raise
+                logger.warning(f"LLM backend {backend.name} failed, trying another: {first_line(e)}")
+                error = e
+                continue
+            self.finish(backend, started)
+            return
+
+    def stats(self):
+        with self.lock:
+            return {
+                backend.name: {
+                    'outstanding': backend.outstanding,
+                    'calls': backend.calls,
+                    'errors': backend.errors,
+                    'throttled': backend.throttled,
+                    'cooling_down': backend.cooling_down(),
+                    'p50_ms': round(sorted(backend.latencies)[len(backend.latencies) // 2] * 1000, 1) if backend.latencies else None,
+                    'hedge_delay_ms': round(backend.latency_p95() * 1000, 1),
+                    'hedges': backend.hedges,
+                    'hedges_won': backend.hedges_won,
+                }
+                for backend in self.backends
+            }
+
+def llm_client(config, max_retries):
+    # 'kind' picks the chat or completions API; Azure deployments are chat deployments unless configured otherwise.
+    if config.get('type', 'openai') == 'azure':
+        if config.get('kind', 'chat') == 'chat':
+            return AzureChatOpenAI(
+                azure_deployment=config['deployment'],
+                azure_endpoint=config.get('endpoint', azure_endpoint),
+                openai_api_key=config.get('api_key', azure_api_key),
+                openai_api_version=config.get('api_version', openai_api_version),
+                max_retries=max_retries,
+            )
+        return AzureOpenAI(
+            deployment_name=config['deployment'],
+            azure_endpoint=config.get('endpoint', azure_endpoint),
+            openai_api_key=config.get('api_key', azure_api_key),
+            openai_api_version=config.get('api_version', openai_api_version),
+            max_retries=max_retries,
+        )
+    if config.get('kind', 'completion') == 'chat':
+        return ChatOpenAI(openai_api_key=config.get('api_key', API_KEY), model_name=config.get('model', 'gpt-3.5-turbo'), max_retries=max_retries)
+    if 'model' in config:
+        return OpenAI(openai_api_key=config.get('api_key', API_KEY), model_name=config['model'], max_retries=max_retries)
+    return OpenAI(openai_api_key=config.get('api_key', API_KEY), max_retries=max_retries)
+
+backend_configs = list(LLM_BACKENDS)
+if not backend_configs:
+    if API_KEY:
+        backend_configs.append({'name': 'openai', 'type': 'openai'})
+    if azure_deployment and azure_endpoint:
+        backend_configs.extend({'name': f"azure-{name.strip()}", 'type': 'azure', 'deployment': name.strip()} for name in azure_deployment.split(','))
+# Retry rounds run in LLMPool under the request deadline; the SDK's own retries would each get the full remaining timeout.
+# With several backends failing over is usually enough, so extra rounds default to off.
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '0' if len(backend_configs) > 1 else '2'))
+LLM_RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', '0.5'))
+llm = LLMPool([
+    LLMBackend(config.get('name', f"{config.get('type', 'openai')}-{position}"), llm_client(config, 0))
+    for position, config in enumerate(backend_configs)
+])
+logger.info(f"LLM pool created with backends: {', '.join(backend.name for backend in llm.backends)}.")
 PROMPT = """
 The question: {question}
 """
 
-PROMPT1 = """
+PROMPT1_RULES = """
 - Return only 10 rows if the user doesn't specify the row count.
 - Retrieve only distinct results.
 - Inform the user if all records cannot be displayed upon request.
@@ -74,7 +341,9 @@ PROMPT1 = """
 - Do not provide an answer if the question is unrelated to the database.
 - If the column name is not specified in the question, use the last value in the question as the asset item or name.
 - If there is confusion in selecting which column to choose in the WHERE clause, select all related columns based on the values given in the question's context.
-- This is the test sql query and user question.
+"""
+
+PROMPT1_EXAMPLE = """- This is the test sql query and user question.
 - Assets and Locations are the main columns to query.
 - The Question :- what is the Manufacturer of the Deep Fryer
 - The SQL Query :-  SELECT DISTINCT [Manufacturer]
@@ -88,45 +357,2447 @@ PROMPT1 = """
                     OR [Endoflife] LIKE '%2022-04-04%'
                     ORDER BY [Manufacturer] DESC
                     OFFSET 0 ROWS FETCH NEXT 10 ROWS ONLY;
+"""
 
+PROMPT1_QUESTION = """
 The question: {question}
 The error: {error}
 """
 
+PROMPT1 = PROMPT1_RULES + PROMPT1_EXAMPLE + PROMPT1_QUESTION
+
+# Defaults to the engine's pool_size so a running query never waits on a connection.
+QUERY_WORKERS = int(os.getenv('QUERY_WORKERS', '20'))
+# Every gunicorn worker gets its own pool, so split the server's connection budget between them.
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+DB_MAX_CONNECTIONS = int(os.getenv('DB_MAX_CONNECTIONS', '100'))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', str(max(1, min(QUERY_WORKERS, DB_MAX_CONNECTIONS // WEB_CONCURRENCY)))))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '0'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_WARMUP = int(os.getenv('DB_POOL_WARMUP', str(DB_POOL_SIZE)))
+
 try:
     logger.info("Attempting to create database engine.")
-    engine = create_engine(url, pool_size=20, max_overflow=0)
-    logger.info("Database engine created successfully.")
+    engine = create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    logger.info(f"Database engine created successfully with a pool of {DB_POOL_SIZE} connections.")
 except SQLAlchemyError as e:
     logger.critical(f"Error creating database engine: {e}", exc_info=True)
     raise
 
+VIEW_NAME = 'MyAiView'
+
+SCHEMA_SNAPSHOT_VERSION = 1
+SCHEMA_SNAPSHOT_PATH = os.getenv('SCHEMA_SNAPSHOT_PATH', 'schema_snapshot.json')
+SCHEMA_CHECK_INTERVAL = float(os.getenv('SCHEMA_CHECK_INTERVAL', '300'))
+SCHEMA_REFRESH_INTERVAL = float(os.getenv('SCHEMA_REFRESH_INTERVAL', '86400'))
+SCHEMA_SAMPLE_ROWS = int(os.getenv('SCHEMA_SAMPLE_ROWS', '10'))
+PROMPT_SAMPLE_ROWS = int(os.getenv('PROMPT_SAMPLE_ROWS', '3'))
+prompt_columns_str = os.getenv('PROMPT_COLUMNS')
+PROMPT_COLUMNS = ast.literal_eval(prompt_columns_str) if prompt_columns_str else []
+
+def view_definition_hash():
+    with engine.connect() as connection:
+        if engine.dialect.name == 'mssql':
+            definition = connection.execute(text("SELECT OBJECT_DEFINITION(OBJECT_ID(:name))"), {'name': VIEW_NAME}).scalar()
+        elif engine.dialect.name == 'sqlite':
+            definition = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = :name"), {'name': VIEW_NAME}).scalar()
+        else:
+            definition = str(inspect(connection).get_columns(VIEW_NAME))
+    return hashlib.sha256((definition or '').encode()).hexdigest()
+
+class SchemaSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = None
+        self.table_info = ""
+        self.listeners = []
+        self.thread = None
+
+    def load(self):
+        try:
+            with open(self.path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (OSError, ValueError):
+            return False
+        if data.get('format') != SCHEMA_SNAPSHOT_VERSION or data.get('view') != VIEW_NAME:
+            logger.warning(f"Ignoring incompatible schema snapshot {self.path}.")
+            return False
+        self.set(data)
+        logger.info(f"Loaded schema snapshot revision {data['revision']} from {self.path}.")
+        return True
+
+    def build(self, definition_hash):
+        table = Table(VIEW_NAME, MetaData(), autoload_with=engine)
+        columns = [column for column in table.columns if type(column.type) is not NullType]
+        with engine.connect() as connection:
+            rows = connection.execute(select(*columns).limit(SCHEMA_SAMPLE_ROWS)).fetchall()
+        return {
+            'format': SCHEMA_SNAPSHOT_VERSION,
+            'view': VIEW_NAME,
+            'revision': (self.data or {}).get('revision', 0) + 1,
+            'definition_hash': definition_hash,
+            'created_at': time.time(),
+            'columns': [
+                {'name': column.name, 'type': column.type.compile(dialect=engine.dialect), 'nullable': column.nullable}
+                for column in columns
+            ],
+            'sample_rows': [[str(value)[:100] for value in row] for row in rows],
+        }
+
+    def set(self, data):
+        with self.lock:
+            self.data = data
+            self.table_info = self.render(data)
+
+    def render(self, data):
+        columns = [column for column in data['columns'] if not PROMPT_COLUMNS or column['name'] in PROMPT_COLUMNS]
+        positions = [data['columns'].index(column) for column in columns]
+        lines = [f"\t[{column['name']}] {column['type']}{'' if column['nullable'] else ' NOT NULL'}" for column in columns]
+        table_info = f"CREATE TABLE [{VIEW_NAME}] (\n" + ",\n".join(lines) + "\n)"
+        sample_rows = data['sample_rows'][:PROMPT_SAMPLE_ROWS]
+        if sample_rows:
+            header = "\t".join(column['name'] for column in columns)
+            rows = "\n".join("\t".join(row[position] for position in positions) for row in sample_rows)
+            table_info += f"\n\n/*\n{len(sample_rows)} rows from {VIEW_NAME} table:\n{header}\n{rows}\n*/"
+        return table_info
+
+    def save(self, data):
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(data, snapshot_file)
+        os.replace(temporary_path, self.path)
+
+    def refresh(self, force=False):
+        definition_hash = view_definition_hash()
+        changed = self.data is not None and definition_hash != self.data['definition_hash']
+        stale = self.data is None or time.time() - self.data['created_at'] > SCHEMA_REFRESH_INTERVAL
+        if not (force or changed or stale):
+            return False
+        data = self.build(definition_hash)
+        self.save(data)
+        self.set(data)
+        logger.info(f"Schema snapshot refreshed to revision {data['revision']}.")
+        if changed:
+            self.notify()
+        return True
+
+    def reload(self):
+        # Picks up a snapshot another worker refreshed and saved.
+        previous = self.data['definition_hash'] if self.data else None
+        if self.load() and self.data['definition_hash'] != previous:
+            self.notify()
+
+    def notify(self):
+        logger.info(f"{VIEW_NAME} definition changed, notifying {len(self.listeners)} listeners.")
+        for listener in self.listeners:
+            listener()
+
+    def run(self):
+        while True:
+            time.sleep(SCHEMA_CHECK_INTERVAL)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Schema snapshot refresh failed: {e}")
+
+    def start(self):
+        if self.thread is None and SCHEMA_CHECK_INTERVAL > 0:
+            self.thread = threading.Thread(target=self.run, name='schema-refresh', daemon=True)
+            self.thread.start()
+
+    def columns(self):
+        return [column['name'] for column in self.data['columns']]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'revision': self.data['revision'],
+                'definition_hash': self.data['definition_hash'],
+                'created_at': self.data['created_at'],
+                'columns': len(self.data['columns']),
+                'prompt_columns': len(PROMPT_COLUMNS) or len(self.data['columns']),
+                'prompt_sample_rows': min(PROMPT_SAMPLE_ROWS, len(self.data['sample_rows'])),
+                'table_info_chars': len(self.table_info),
+            }
+
+schema_snapshot = SchemaSnapshot(SCHEMA_SNAPSHOT_PATH)
+try:
+    if not schema_snapshot.load():
+        logger.info("Building schema snapshot from the database.")
+        schema_snapshot.refresh(force=True)
+except Exception as e:
+    logger.critical(f"Error building schema snapshot: {e}", exc_info=True)
+    raise
+
 try:
     logger.info("Attempting to create SQLDatabase instance.")
-    db = SQLDatabase(engine, view_support=True, indexes_in_table_info=True, include_tables=['MyAiView'])
+    # Columns and sample rows come from schema_snapshot, so the view is not reflected again here.
+    db = SQLDatabase(engine, view_support=True, indexes_in_table_info=True, include_tables=[VIEW_NAME], lazy_table_reflection=True)
     logger.info("SQLDatabase instance created successfully.")
 except Exception as e:
     logger.critical(f"Error creating SQLDatabase instance: {e}", exc_info=True)
     raise
 
-db_chain = SQLDatabaseChain.from_llm(llm=llm, use_query_checker=True, db=db, return_sql=False, return_intermediate_steps=False, verbose=True)
+db_chain = SQLDatabaseChain.from_llm(llm=llm.backends[0].client, use_query_checker=True, db=db, return_sql=False, return_intermediate_steps=False, verbose=True)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+current_stage = contextvars.ContextVar('current_stage', default='other')
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+request_user = contextvars.ContextVar('request_user', default=None)
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded during {stage}.")
+        self.stage = stage
+
+def time_left():
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded(current_stage.get())
+    return left
+
+def metric_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = OrderedDict()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[position] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name, help_text, read, kind='gauge'):
+        # Read at scrape time; kind='counter' for totals that other components already keep and only ever increase.
+        self.describe(name, kind, help_text)
+        self.gauges[name] = read
+
+    @contextmanager
+    def stage(self, stage):
+        token = current_stage.set(stage)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+            current_stage.reset(token)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+        for name, (kind, help_text) in self.descriptions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.gauges:
+                try:
+                    values = self.gauges[name]()
+                except Exception as e:
+                    logger.warning(f"Metric {name} could not be read: {e}")
+                    continue
+                if isinstance(values, dict):
+                    lines.extend(f"{name}{metric_labels(dict(labels))} {value}" for labels, value in values.items())
+                else:
+                    lines.append(f"{name} {values}")
+            elif kind == 'counter':
+                lines.extend(f"{name}{metric_labels(dict(labels))} {value}" for (metric, labels), value in counters if metric == name)
+            elif kind == 'histogram':
+                for (metric, labels), histogram in histograms:
+                    if metric != name:
+                        continue
+                    labels = dict(labels)
+                    for bound, count in zip(LATENCY_BUCKETS, histogram):
+                        lines.append(f"{name}_bucket{metric_labels(dict(labels, le=bound))} {count}")
+                    lines.append(f"{name}_bucket{metric_labels(dict(labels, le='+Inf'))} {histogram[-1]}")
+                    lines.append(f"{name}_sum{metric_labels(labels)} {histogram[-2]}")
+                    lines.append(f"{name}_count{metric_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('request_seconds', 'histogram', 'End-to-end latency of processed user queries.')
+metrics.describe('stage_seconds', 'histogram', 'Latency of each pipeline stage.')
+metrics.describe('db_checkout_seconds', 'histogram', 'Time spent waiting for a pooled SQL Server connection.')
+metrics.describe('requests_total', 'counter', 'Processed user queries by outcome.')
+metrics.describe('path_total', 'counter', 'Executions of each answer path by outcome.')
+metrics.describe('llm_calls_total', 'counter', 'LLM calls by stage.')
+metrics.describe('llm_tokens_total', 'counter', 'LLM tokens by stage and kind.')
+metrics.describe('rate_limited_total', 'counter', 'Requests rejected by per-user rate limits.')
+metrics.describe('user_llm_tokens_total', 'counter', 'LLM tokens charged to each user.')
+metrics.describe('llm_backend_requests_total', 'counter', 'Requests sent to each LLM backend by outcome.')
+metrics.describe('llm_backend_seconds', 'histogram', 'Latency of successful requests to each LLM backend.')
+metrics.describe('export_rows_total', 'counter', 'Rows returned by the export endpoint by format.')
+metrics.describe('export_truncated_total', 'counter', 'Exports cut off at EXPORT_MAX_ROWS by format.')
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    def on_llm_end(self, response, **kwargs):
+        stage = current_stage.get()
+        metrics.inc('llm_calls_total', stage=stage)
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        for kind in ('prompt', 'completion'):
+            if usage.get(f"{kind}_tokens"):
+                metrics.inc('llm_tokens_total', usage[f"{kind}_tokens"], stage=stage, kind=kind)
+
+llm_callbacks = {'callbacks': [MetricsCallbackHandler()]}
+
+# The stages below mirror SQLDatabaseChain._call so each one can be skipped or reused on its own.
+SQL_QUERY = "SQLQuery:"
+SQL_RESULT = "SQLResult:"
+query_checker_prompt = PromptTemplate(template=QUERY_CHECKER, input_variables=["query", "dialect"])
+
+def chain_inputs(input_text):
+    return {
+        "input": input_text,
+        "top_k": str(db_chain.top_k),
+        "dialect": db.dialect,
+        "table_info": schema_snapshot.table_info,
+    }
+
+def ignore_event(event, data):
+    pass
+
+def predict(prompt, inputs, stop=None):
+    try:
+        result = llm.invoke(prompt.format(**inputs), config=llm_callbacks, stop=stop).strip()
+    except openai.APITimeoutError:
+        time_left()
+        raise
+    time_left()
+    return result
+
+def predict_stream(prompt, inputs, emit, stop=None):
+    tokens = []
+    try:
+        for token in llm.stream(prompt.format(**inputs), config=llm_callbacks, stop=stop):
+            tokens.append(token)
+            emit('answer_token', {'token': token})
+            time_left()
+    except openai.APITimeoutError:
+        time_left()
+        raise
+    return "".join(tokens).strip()
+
+def generate_sql(input_text):
+    with metrics.stage('generate'):
+        sql = predict(db_chain.llm_chain.prompt, chain_inputs(input_text), stop=["\nSQLResult:"])
+    if SQL_QUERY in sql:
+        sql = sql.split(SQL_QUERY)[1].strip()
+    if SQL_RESULT in sql:
+        sql = sql.split(SQL_RESULT)[0].strip()
+    return sql
+
+LOCAL_SQL_VALIDATION = os.getenv('LOCAL_SQL_VALIDATION', 'true').lower() in ('1', 'true', 'yes')
+
+SQL_KEYWORDS = {
+    'select', 'distinct', 'top', 'percent', 'with', 'ties', 'from', 'where', 'and', 'or', 'not', 'in', 'is',
+    'null', 'like', 'escape', 'between', 'as', 'on', 'join', 'inner', 'left', 'right', 'outer', 'full', 'cross',
+    'apply', 'group', 'by', 'order', 'having', 'asc', 'desc', 'offset', 'rows', 'row', 'fetch', 'next', 'first',
+    'only', 'limit', 'case', 'when', 'then', 'else', 'end', 'union', 'all', 'exists', 'any', 'some', 'over',
+    'partition', 'collate', 'nolock', 'count', 'sum', 'avg', 'min', 'max', 'cast', 'convert', 'try_cast',
+    'isnull', 'coalesce', 'nullif', 'iif', 'len', 'lower', 'upper', 'ltrim', 'rtrim', 'trim', 'substring',
+    'charindex', 'replace', 'concat', 'format', 'getdate', 'date', 'datetime', 'datepart', 'datediff',
+    'dateadd', 'year', 'month', 'day', 'varchar', 'nvarchar', 'char', 'int', 'bigint', 'float', 'decimal',
+    'bit', 'row_number', 'rank', 'dense_rank', 'dbo',
+}
+SQL_FORBIDDEN = {
+    'insert', 'update', 'delete', 'merge', 'drop', 'alter', 'create', 'truncate', 'exec', 'execute', 'grant',
+    'revoke', 'deny', 'into', 'openrowset', 'openquery', 'shutdown', 'backup', 'restore', 'dbcc',
+}
+
+class SQLValidationError(Exception):
+    pass
+
+def view_columns():
+    return set(schema_snapshot.columns())
+
+def validate_sql(sql):
+    # True: safe to run as-is, False: undecided (ask the LLM checker), SQLValidationError: never run it.
+    code = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.S)
+    code = re.sub(r"(?:(?<!\w)N)?'(?:[^']|'')*'", "''", code).strip().rstrip(';').strip()
+    if ';' in code:
+        raise SQLValidationError("Only a single statement is allowed.")
+    if not re.match(r"(?:select|with)\b|\(", code, re.I):
+        raise SQLValidationError("Only SELECT statements are allowed.")
+    words = {word.lower() for word in re.findall(r"[A-Za-z_@#][\w@#$]*", re.sub(r"\[[^\]]*\]", " ", code))}
+    forbidden = words & SQL_FORBIDDEN
+    if forbidden:
+        raise SQLValidationError(f"Statement uses forbidden keyword {sorted(forbidden)[0].upper()}.")
+    if not re.match(r"select\b", code, re.I):
+        # A CTE or parenthesized query is read-only once the keywords above are ruled out; its names and shape are the checker's call.
+        return False
+
+    columns = view_columns()
+    known = {name.lower() for name in columns} | {name.lower() for name in db.get_usable_table_names()} | {'dbo'}
+    aliases = {alias.strip('[]').lower() for alias in re.findall(r"\bAS\s+(\[[^\]]+\]|\w+)", code, re.I)}
+    aliases |= {alias.strip('[]').lower() for alias in re.findall(r"\)\s*(\[[^\]]+\])", code)}
+    aliases |= {alias.lower() for alias in re.findall(r"\b(?:FROM|JOIN)\s+(?:\[[^\]]+\]\.)?\[?\w+\]?\s+(?:AS\s+)?(\w+)", code, re.I)}
+    for identifier in re.findall(r"\[([^\]]+)\]", code):
+        if identifier.lower() not in known and identifier.lower() not in aliases:
+            raise SQLValidationError(f"Invalid column name '{identifier}'.")
+
+    bare = re.sub(r"\[[^\]]*\]", " ", code)
+    for column in columns:
+        if not re.fullmatch(r"\w+", column) and re.search(r"(?<![\w\[])" + re.escape(column) + r"(?![\w\]])", bare):
+            return False
+    if words - SQL_KEYWORDS - known - aliases:
+        return False
+
+    limited = re.search(r"\bTOP\s*\(?\s*\d+|\bOFFSET\s+\d+\s+ROWS?\s+FETCH\s+(?:NEXT|FIRST)\s+\d+", code, re.I)
+    if db.dialect != 'mssql':
+        limited = limited or re.search(r"\bLIMIT\s+\d+", code, re.I)
+    aggregate_only = (
+        re.match(r"select\s+(?:count|sum|avg|min|max)\s*\(", code, re.I)
+        and not re.search(r"\bgroup\s+by\b|\b(?:union|except|intersect)\b", code, re.I)
+    )
+    return bool(limited or aggregate_only)
+
+class QueryCheckerStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.skipped = 0
+        self.rejected = 0
+        self.local_seconds = 0.0
+
+    def record(self, outcome, seconds):
+        with self.lock:
+            if outcome == 'llm':
+                self.llm_calls += 1
+                self.llm_seconds += seconds
+            else:
+                self.local_seconds += seconds
+                if outcome == 'skipped':
+                    self.skipped += 1
+                elif outcome == 'rejected':
+                    self.rejected += 1
+
+    def stats(self):
+        with self.lock:
+            average = self.llm_seconds / self.llm_calls if self.llm_calls else 0.0
+            return {
+                'llm_calls': self.llm_calls,
+                'llm_calls_saved': self.skipped,
+                'rejected_locally': self.rejected,
+                'avg_llm_ms': round(average * 1000, 1),
+                'local_ms': round(self.local_seconds * 1000, 1),
+                'estimated_ms_saved': round((self.skipped * average - self.local_seconds) * 1000, 1),
+            }
+
+query_checker_stats = QueryCheckerStats()
+
+def check_sql(sql):
+    if LOCAL_SQL_VALIDATION:
+        started = time.perf_counter()
+        try:
+            with metrics.stage('check_local'):
+                valid = validate_sql(sql)
+        except SQLValidationError:
+            query_checker_stats.record('rejected', time.perf_counter() - started)
+            raise
+        query_checker_stats.record('skipped' if valid else 'undecided', time.perf_counter() - started)
+        if valid:
+            return sql
+
+    started = time.perf_counter()
+    with metrics.stage('check_llm'):
+        checked = predict(query_checker_prompt, {"query": sql, "dialect": db.dialect})
+    query_checker_stats.record('llm', time.perf_counter() - started)
+    if LOCAL_SQL_VALIDATION:
+        validate_sql(checked)
+    return checked
+
+REPLICA_ENABLED = os.getenv('REPLICA_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+REPLICA_PATH = os.getenv('REPLICA_PATH', 'myaiview_replica.sqlite3')
+REPLICA_REFRESH_INTERVAL = float(os.getenv('REPLICA_REFRESH_INTERVAL', '300'))
+REPLICA_MAX_AGE = float(os.getenv('REPLICA_MAX_AGE', '900'))
+REPLICA_CHANGE_COLUMN = os.getenv('REPLICA_CHANGE_COLUMN')
+REPLICA_UNSUPPORTED = re.compile(r"\b(?:APPLY|PIVOT|UNPIVOT|COLLATE|PERCENT|TIES|OVER|NOLOCK|OUTPUT|INTO)\b|@@|#", re.I)
+# Only calls that mean the same thing in SQLite on the replica's untyped columns; CAST, CONVERT, date math and the
+# rest run on SQL Server, since SQLite would run them without error and answer something else.
+REPLICA_FUNCTIONS = {'count', 'sum', 'avg', 'min', 'max', 'len', 'isnull', 'coalesce', 'nullif', 'lower', 'upper', 'ltrim', 'rtrim', 'abs', 'getdate'}
+REPLICA_CLAUSES = {
+    'select', 'distinct', 'from', 'where', 'and', 'or', 'not', 'in', 'exists', 'on', 'join', 'as', 'when', 'then',
+    'else', 'by', 'having', 'union', 'all', 'any', 'some', 'with', 'is', 'like', 'between',
+}
+
+def replica_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(sep=' ') if hasattr(value, 'hour') and hasattr(value, 'year') else value.isoformat()
+    if isinstance(value, bytes):
+        return value.hex()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+def mask_literals(sql):
+    # Swaps string literals for numbered placeholders so the rewrites below can't match inside them.
+    literals = []
+
+    def keep(match):
+        literals.append(match.group(0))
+        return f"'\x00{len(literals) - 1}'"
+
+    return re.sub(r"(?<!\w)N?'(?:[^']|'')*'", keep, sql.strip().rstrip(';')), literals
+
+def restore_literals(code, literals, unicode_prefix=True):
+    return re.sub(r"'\x00(\d+)'", lambda match: literals[int(match.group(1))] if unicode_prefix else literals[int(match.group(1))].lstrip('N'), code)
+
+def translate_tsql(sql):
+    # Rewrites the T-SQL subset the chain generates into SQLite, or returns None when it can't.
+    code, literals = mask_literals(sql)
+    bare = re.sub(r"\[[^\]]*\]", "[]", code)
+    if REPLICA_UNSUPPORTED.search(bare) or ';' in code:
+        return None
+    if {name.lower() for name in re.findall(r"\b([A-Za-z_]\w*)\s*\(", bare)} - REPLICA_FUNCTIONS - REPLICA_CLAUSES - {'top'}:
+        return None
+    # + concatenates strings in T-SQL but always adds in SQLite; only an exponent sign is safe.
+    if '+' in re.sub(r"\d[eE]\+\d", "", bare):
+        return None
+    # SQLite's LIKE has no [a-z] character classes.
+    if any('[' in literals[int(index)] for index in re.findall(r"\bLIKE\s+'\x00(\d+)'", code, re.I)):
+        return None
+
+    limit = None
+    top = re.match(r"(\s*SELECT\s+(?:DISTINCT\s+)?)TOP\s*\(?\s*(\d+)\s*\)?\s+", code, re.I)
+    if top:
+        code = top.group(1) + code[top.end():]
+        limit = f" LIMIT {top.group(2)}"
+    paging = re.search(r"\s+OFFSET\s+(\d+)\s+ROWS?(?:\s+FETCH\s+(?:NEXT|FIRST)\s+(\d+)\s+ROWS?\s+ONLY)?\s*$", code, re.I)
+    if paging:
+        if limit is not None:
+            return None
+        code = code[:paging.start()]
+        limit = f" LIMIT {paging.group(2) or -1} OFFSET {paging.group(1)}"
+    if re.search(r"\bTOP\b|\bOFFSET\b|\bFETCH\b", code, re.I):
+        return None
+
+    code = re.sub(r"\bGETDATE\s*\(\s*\)", "datetime('now')", code, flags=re.I)
+    code = re.sub(r"\bLEN\s*\(", "length(", code, flags=re.I)
+    code = re.sub(r"\bISNULL\s*\(", "ifnull(", code, flags=re.I)
+    code = re.sub(r"\[dbo\]\.|\bdbo\.", "", code, flags=re.I)
+    code += limit or ""
+    return restore_literals(code, literals, unicode_prefix=False)
+
+class LocalReplica:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.engine = None
+        self.refreshed_at = None
+        self.probe = None
+        self.rows = 0
+        self.refresh_seconds = 0.0
+        self.counts = {'local': 0, 'remote_stale': 0, 'remote_untranslatable': 0, 'local_errors': 0}
+        self.thread = None
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def fresh(self):
+        return self.refreshed_at is not None and time.time() - self.refreshed_at <= REPLICA_MAX_AGE
+
+    def remote_probe(self):
+        with engine.connect() as connection:
+            if REPLICA_CHANGE_COLUMN:
+                return tuple(connection.exec_driver_sql(f"SELECT COUNT(*), MAX([{REPLICA_CHANGE_COLUMN}]) FROM [{VIEW_NAME}]").fetchone())
+            if engine.dialect.name == 'mssql':
+                return tuple(connection.exec_driver_sql(f"SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(*)) FROM [{VIEW_NAME}]").fetchone())
+        return None
+
+    def refresh(self):
+        started = time.perf_counter()
+        probe = self.remote_probe()
+        columns = schema_snapshot.columns()
+        local = sqlite3.connect(self.path, timeout=30)
+        try:
+            local.execute("PRAGMA journal_mode=WAL")
+            # Gunicorn workers share the replica file, so each refresh diffs and writes under one write lock.
+            local.execute("BEGIN IMMEDIATE")
+            local.execute("CREATE TABLE IF NOT EXISTS replica_meta (key TEXT PRIMARY KEY, value TEXT)")
+            signature = json.dumps(columns)
+            stored = local.execute("SELECT value FROM replica_meta WHERE key = 'columns'").fetchone()
+            if stored is None or stored[0] != signature:
+                local.execute(f"DROP TABLE IF EXISTS [{VIEW_NAME}]")
+                definitions = ", ".join(f"[{column}] COLLATE NOCASE" for column in columns)
+                local.execute(f"CREATE TABLE [{VIEW_NAME}] ({definitions}, [__row_hash] TEXT NOT NULL)")
+                local.execute(f"CREATE INDEX IF NOT EXISTS [{VIEW_NAME}__row_hash] ON [{VIEW_NAME}] ([__row_hash])")
+                local.execute("INSERT OR REPLACE INTO replica_meta VALUES ('columns', ?)", (signature,))
+                self.probe = None
+            elif probe is not None and probe == self.probe:
+                self.refreshed_at = time.time()
+                return 0, 0
+
+            selected = ", ".join(f"[{column}]" for column in columns)
+            with engine.connect() as connection:
+                remote_rows = [
+                    [replica_value(value) for value in row]
+                    for row in connection.exec_driver_sql(f"SELECT {selected} FROM [{VIEW_NAME}]")
+                ]
+            remote = {}
+            for row in remote_rows:
+                remote.setdefault(hashlib.sha1(json.dumps(row, default=str).encode()).hexdigest(), []).append(row)
+            existing = {}
+            for (row_hash,) in local.execute(f"SELECT [__row_hash] FROM [{VIEW_NAME}]"):
+                existing[row_hash] = existing.get(row_hash, 0) + 1
+
+            removed = added = 0
+            placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+            for row_hash, count in existing.items():
+                surplus = count - len(remote.get(row_hash, []))
+                if surplus > 0:
+                    local.execute(f"DELETE FROM [{VIEW_NAME}] WHERE rowid IN (SELECT rowid FROM [{VIEW_NAME}] WHERE [__row_hash] = ? LIMIT ?)", (row_hash, surplus))
+                    removed += surplus
+            for row_hash, rows in remote.items():
+                for row in rows[existing.get(row_hash, 0):]:
+                    local.execute(f"INSERT INTO [{VIEW_NAME}] VALUES ({placeholders})", row + [row_hash])
+                    added += 1
+            local.commit()
+        finally:
+            local.close()
+
+        if self.engine is None:
+            self.engine = create_engine(f"sqlite:///file:{os.path.abspath(self.path)}?mode=ro&uri=true")
+        self.probe = probe
+        self.rows = len(remote_rows)
+        self.refreshed_at = time.time()
+        self.refresh_seconds = time.perf_counter() - started
+        logger.info(f"Local replica refreshed: {added} added, {removed} removed, {self.rows} rows in {self.refresh_seconds:.3f}s.")
+        return added, removed
+
+    def execute(self, sql, parameters=None):
+        if not self.fresh():
+            self.count('remote_stale')
+            return None
+        local_sql = translate_tsql(sql)
+        if local_sql is None:
+            self.count('remote_untranslatable')
+            return None
+        try:
+            result = run_statement(self.engine, local_sql, parameters)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.warning(f"Local replica could not run statement, using SQL Server: {e}")
+            self.count('local_errors')
+            return None
+        self.count('local')
+        return result
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Local replica refresh failed: {e}")
+            time.sleep(REPLICA_REFRESH_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='replica-refresh', daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counts,
+                enabled=REPLICA_ENABLED,
+                fresh=self.fresh(),
+                rows=self.rows,
+                age=round(time.time() - self.refreshed_at, 1) if self.refreshed_at else None,
+                refresh_ms=round(self.refresh_seconds * 1000, 1),
+            )
+
+replica = LocalReplica(REPLICA_PATH)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def track_cursor(connection, cursor, statement, parameters, context, executemany):
+    connection.info['cursor'] = cursor
+
+def set_statement_timeout(connection, seconds):
+    # pyodbc applies Connection.timeout to every statement until it is reset, so pooled connections must go back at 0.
+    if connection.dialect.name == 'mssql':
+        connection.connection.driver_connection.timeout = seconds
+
+def cancel_statement(connection, cancelled):
+    cancelled.set()
+    cursor = connection.info.get('cursor')
+    try:
+        if hasattr(cursor, 'cancel'):
+            cursor.cancel()
+        else:
+            connection.connection.driver_connection.interrupt()
+    except Exception as e:
+        logger.warning(f"Could not cancel statement at the request deadline: {e}")
+
+def execute_statement(connection, sql, parameters=None):
+    if parameters:
+        return connection.execute(text(sql), parameters)
+    return connection.exec_driver_sql(sql)
+
+def fetch_statement(connection, sql, parameters=None):
+    cursor = execute_statement(connection, sql, parameters)
+    if not cursor.returns_rows:
+        return [], []
+    return list(cursor.keys()), cursor.fetchall()
+
+@contextmanager
+def statement_deadline(connection, stage, deadline):
+    if deadline is None:
+        yield
+        return
+    timeout = deadline - time.monotonic()
+    if timeout <= 0:
+        raise DeadlineExceeded(stage)
+    connection.info.pop('cursor', None)
+    cancelled = threading.Event()
+    timer = threading.Timer(timeout, cancel_statement, (connection, cancelled))
+    # The server-side timeout rounds up, so the timer normally cancels first and the timeout is the backstop.
+    set_statement_timeout(connection, math.ceil(timeout))
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        if cancelled.is_set() or time.monotonic() >= deadline:
+            raise DeadlineExceeded(stage) from e
+        raise
+    finally:
+        timer.cancel()
+        if cancelled.is_set():
+            # A cancelled statement can leave the connection mid-result; drop it instead of returning it to the pool.
+            connection.invalidate()
+        else:
+            set_statement_timeout(connection, 0)
+
+def run_statement(target_engine, sql, parameters=None):
+    stage = 'execute_mssql' if target_engine is engine else 'execute_replica'
+    with metrics.stage(stage):
+        time_left()
+        started = time.perf_counter()
+        with target_engine.connect() as connection:
+            if target_engine is engine:
+                metrics.observe('db_checkout_seconds', time.perf_counter() - started)
+            with statement_deadline(connection, stage, request_deadline.get()):
+                return fetch_statement(connection, sql, parameters)
+
+def execute_sql(sql, parameters=None):
+    if REPLICA_ENABLED:
+        result = replica.execute(sql, parameters)
+        if result is not None:
+            return result
+    return run_statement(engine, sql, parameters)
+
+def format_sql_result(rows):
+    if not rows:
+        return ""
+    return str([tuple(truncate_word(value, length=db._max_string_length) for value in row) for row in rows])
+
+ANSWER_MODES = ('auto', 'llm', 'direct')
+FORMAT_MAX_ROWS = int(os.getenv('FORMAT_MAX_ROWS', '10'))
+FORMAT_MAX_COLUMNS = int(os.getenv('FORMAT_MAX_COLUMNS', '3'))
+EMPTY_ANSWER = "The details are null or unavailable for this question."
+
+def format_value(value):
+    if value is None:
+        return "not available"
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return truncate_word(str(value).strip(), length=db._max_string_length)
+
+def join_values(values):
+    return values[0] if len(values) == 1 else ", ".join(values[:-1]) + " and " + values[-1]
+
+def column_label(column):
+    # Unaliased expressions come back as '' from pyodbc or as the raw expression from SQLite; neither reads as a name.
+    return column if re.fullmatch(r"\w[\w#. ]*", column or "") else None
+
+def format_answer(sql, columns, rows, complete=False):
+    # Renders small result shapes without the LLM; returns None when the result needs synthesis.
+    rows = [row for row in rows if any(value is not None and str(value).strip() for value in row)]
+    if not rows:
+        return EMPTY_ANSWER
+    if not complete and (len(rows) > FORMAT_MAX_ROWS or len(columns) > FORMAT_MAX_COLUMNS):
+        return None
+    labels = [column_label(column) for column in columns]
+    if len(columns) > 1 and None in labels:
+        if not complete:
+            return None
+        columns = [label or f"column {position}" for position, label in enumerate(labels, 1)]
+
+    if len(columns) == 1 and len(rows) == 1:
+        answer = f"The {labels[0] or 'result'} is {format_value(rows[0][0])}."
+    elif len(columns) == 1:
+        answer = f"The {labels[0] + ' values' if labels[0] else 'results'} are {join_values([format_value(row[0]) for row in rows])}."
+    elif len(rows) == 1:
+        answer = "; ".join(f"{column}: {format_value(value)}" for column, value in zip(columns, rows[0])) + "."
+    else:
+        lines = ["; ".join(f"{column}: {format_value(value)}" for column, value in zip(columns, row)) for row in rows]
+        answer = f"Found {len(rows)} records:\n" + "\n".join(f"- {line}" for line in lines)
+
+    # Only the default row limits truncate; a TOP 1 the question asked for is the whole answer.
+    limit = re.search(r"\bTOP\s*\(?\s*(\d+)|\bFETCH\s+(?:NEXT|FIRST)\s+(\d+)|\bLIMIT\s+(\d+)", sql, re.I)
+    limit = int(next(group for group in limit.groups() if group)) if limit else None
+    if limit in (db_chain.top_k, TEMPLATE_ROW_LIMIT) and len(rows) >= limit:
+        answer += f"\nOnly the first {len(rows)} records are shown; more may be available."
+    return answer
+
+def synthesize_answer(input_text, sql, columns, rows, emit=ignore_event, answer_mode='auto'):
+    if answer_mode != 'llm':
+        started = time.perf_counter()
+        with metrics.stage('answer_direct'):
+            answer = format_answer(sql, columns, rows, complete=answer_mode == 'direct')
+        if answer is not None:
+            path_stats.record('answer_direct', True, time.perf_counter() - started)
+            emit('answer_formatted', {})
+            return answer
+
+    started = time.perf_counter()
+    with metrics.stage('answer_llm'):
+        answer = llm_synthesize_answer(input_text, sql, rows, emit)
+    path_stats.record('answer_llm', True, time.perf_counter() - started)
+    return answer
+
+def llm_synthesize_answer(input_text, sql, rows, emit=ignore_event):
+    input_text += f"{sql}\nSQLResult: {format_sql_result(rows)}\nAnswer:"
+    if emit is ignore_event:
+        return predict(db_chain.llm_chain.prompt, chain_inputs(input_text), stop=["\nSQLResult:"])
+    return predict_stream(db_chain.llm_chain.prompt, chain_inputs(input_text), emit, stop=["\nSQLResult:"])
+
+class QueryStageError(Exception):
+    def __init__(self, stage, error, sql=None):
+        super().__init__(str(error))
+        self.stage = stage
+        self.sql = sql
+
+def first_line(error):
+    return str(error).split('\n')[0]
+
+def run_chain(prompt_text, emit=ignore_event, answer_mode='auto'):
+    input_text = f"{prompt_text}\n{SQL_QUERY}"
+    sql = generate_sql(input_text)
+    emit('sql_generated', {'sql': sql})
+    try:
+        checked = check_sql(sql)
+    except DeadlineExceeded:
+        raise
+    except Exception as error:
+        raise QueryStageError('check', error, sql) from error
+    emit('sql_checked', {'sql': checked})
+    try:
+        columns, rows = execute_sql(checked)
+    except DeadlineExceeded:
+        raise
+    except Exception as error:
+        raise QueryStageError('execute', error, checked) from error
+    emit('rows_fetched', {'count': len(rows)})
+    return synthesize_answer(input_text, checked, columns, rows, emit, answer_mode), checked
+
+SQL_REPAIR_ATTEMPTS = int(os.getenv('SQL_REPAIR_ATTEMPTS', '2'))
+
+REPAIR_PROMPT = PromptTemplate(
+    input_variables=["dialect", "table", "columns", "sql", "error"],
+    template="""The {dialect} query below failed against the [{table}] view.
+Columns: {columns}
+Query: {sql}
+Error: {error}
+Fix the query. Keep it a single SELECT, wrap column names in square brackets and keep the row limit.
+Corrected SQL query only:""",
+)
+
+def repair_sql(sql, error):
+    with metrics.stage('repair'):
+        repaired = predict(REPAIR_PROMPT, {
+            "dialect": db.dialect,
+            "table": VIEW_NAME,
+            "columns": ", ".join(f"[{column}]" for column in sorted(view_columns())),
+            "sql": sql,
+            "error": error,
+        })
+    repaired = re.sub(r"^```(?:sql)?|```$", "", repaired.strip(), flags=re.I).strip()
+    if SQL_QUERY in repaired:
+        repaired = repaired.split(SQL_QUERY)[1].strip()
+    return repaired
+
+def repair_chain(prompt_text, sql, error, emit=ignore_event, answer_mode='auto'):
+    input_text = f"{prompt_text}\n{SQL_QUERY}"
+    for attempt in range(1, SQL_REPAIR_ATTEMPTS + 1):
+        emit('repair', {'attempt': attempt, 'error': error})
+        started = time.perf_counter()
+        try:
+            sql = repair_sql(sql, error)
+            emit('sql_repaired', {'sql': sql})
+            sql = check_sql(sql)
+            columns, rows = execute_sql(sql)
+        except DeadlineExceeded:
+            path_stats.record('repair', False, time.perf_counter() - started)
+            raise
+        except Exception as e:
+            error = first_line(e)
+            logger.warning(f"SQL repair attempt {attempt} failed: {error}")
+            path_stats.record('repair', False, time.perf_counter() - started)
+            continue
+        path_stats.record('repair', True, time.perf_counter() - started)
+        emit('rows_fetched', {'count': len(rows)})
+        return synthesize_answer(input_text, sql, columns, rows, emit, answer_mode), sql
+    raise QueryStageError('repair', error, sql)
+
+class PathStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {}
+
+    def record(self, path, ok, seconds):
+        with self.lock:
+            entry = self.paths.setdefault(path, {'attempts': 0, 'successes': 0, 'seconds': 0.0})
+            entry['attempts'] += 1
+            entry['successes'] += int(ok)
+            entry['seconds'] += seconds
+        metrics.inc('path_total', path=path, outcome='success' if ok else 'failure')
+
+    def stats(self):
+        with self.lock:
+            return {
+                path: {
+                    'attempts': entry['attempts'],
+                    'successes': entry['successes'],
+                    'success_rate': round(entry['successes'] / entry['attempts'], 4),
+                    'avg_ms': round(entry['seconds'] / entry['attempts'] * 1000, 1),
+                }
+                for path, entry in self.paths.items()
+            }
+
+path_stats = PathStats()
+
+def answer_from_sql(prompt_text, sql, emit=ignore_event, answer_mode='auto'):
+    input_text = f"{prompt_text}\n{SQL_QUERY}"
+    columns, rows = execute_sql(sql)
+    emit('rows_fetched', {'count': len(rows)})
+    return synthesize_answer(input_text, sql, columns, rows, emit, answer_mode)
+
+class PlanStore:
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                "key TEXT PRIMARY KEY, question TEXT NOT NULL, sql TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL, uses INTEGER NOT NULL DEFAULT 0)"
+            )
+            connection.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        with self.connect() as connection:
+            row = connection.execute("SELECT sql FROM plans WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE plans SET last_used = ?, uses = uses + 1 WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, question, sql):
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO plans (key, question, sql, created_at, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET question = excluded.question, sql = excluded.sql, last_used = excluded.last_used",
+                (key, question, sql, now, now),
+            )
+
+    def delete(self, key):
+        self.failures += 1
+        with self.connect() as connection:
+            connection.execute("DELETE FROM plans WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.connect() as connection:
+            return connection.execute("DELETE FROM plans").rowcount
+
+    def generation(self, name):
+        # Every worker process shares this file, so invalidations recorded here reach the workers that weren't asked.
+        with self.connect() as connection:
+            row = connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name):
+        with self.connect() as connection:
+            connection.execute("INSERT INTO generations (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,))
+            return connection.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()[0]
+
+    def top_plans(self, limit):
+        with self.connect() as connection:
+            return connection.execute("SELECT question, sql FROM plans ORDER BY uses DESC, last_used DESC LIMIT ?", (limit,)).fetchall()
+
+    def stats(self):
+        with self.connect() as connection:
+            size = connection.execute("SELECT COUNT(*) FROM plans").fetchone()[0]
+        return {'size': size, 'hits': self.hits, 'misses': self.misses, 'failures': self.failures, 'path': self.path}
+
+plan_store = PlanStore(os.getenv('PLAN_CACHE_PATH', 'sql_plans.sqlite3'))
+
+STOP_WORDS = {
+    'a', 'an', 'the', 'of', 'is', 'are', 'was', 'were', 'be', 'for', 'to', 'in', 'on', 'at',
+    'please', 'me', 'us', 'tell', 'show', 'give', 'can', 'could', 'would', 'you', 'do', 'does',
+    'i', 'want', 'know', 'kindly', 'whats', 'what', 'who', 'which',
+}
 
-def process_user_query(user_query, results_container):
+def normalize_question(question):
+    question = question.lower().replace("'", "")
+    words = re.sub(r"[^\w#.]+|(?<!\w)\.|\.(?!\w)", " ", question).split()
+    return " ".join(word for word in words if word not in STOP_WORDS)
+
+class AnswerCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+        self.generation = plan_store.generation('answers')
+
+    def get(self, key):
+        generation = plan_store.generation('answers')
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            entry = self.entries.get(key)
+            if entry is None or entry['expires'] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry['seconds']
+            self.saved_tokens += entry['tokens']
+            return entry['response']
+
+    def put(self, key, response, seconds, tokens):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = {
+                'response': response,
+                'seconds': seconds,
+                'tokens': tokens,
+                'expires': time.monotonic() + self.ttl,
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        generation = plan_store.bump('answers')
+        with self.lock:
+            count = len(self.entries)
+            self.entries.clear()
+            self.generation = generation
+        return count
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'saved_seconds': round(self.saved_seconds, 3),
+                'saved_tokens': self.saved_tokens,
+            }
+
+answer_cache = AnswerCache(int(os.getenv('ANSWER_CACHE_SIZE', '1024')), float(os.getenv('ANSWER_CACHE_TTL', '900')))
+
+def on_schema_change():
+    answer_cache.invalidate()
+    plan_store.clear()
+
+schema_snapshot.listeners.append(on_schema_change)
+
+entity_columns_str = os.getenv('ENTITY_COLUMNS')
+ENTITY_COLUMNS = ast.literal_eval(entity_columns_str) if entity_columns_str else [
+    'Assets', 'Locations', 'CategoryName', 'Manufacturer', 'ModelNo.', 'Model#', 'Model Number',
+]
+ENTITY_MATCH_THRESHOLD = float(os.getenv('ENTITY_MATCH_THRESHOLD', '0.6'))
+ENTITY_REFRESH_INTERVAL = float(os.getenv('ENTITY_REFRESH_INTERVAL', '600'))
+ENTITY_MAX_SPAN = 4
+ENTITY_MEMO_SIZE = int(os.getenv('ENTITY_MEMO_SIZE', '256'))
+ENTITY_HINT_MAX_LINES = int(os.getenv('ENTITY_HINT_MAX_LINES', '8'))
+# Single words that also appear as view values ("True", "Main") but are far more often just words in the question.
+entity_stop_words_str = os.getenv('ENTITY_STOP_WORDS')
+ENTITY_STOP_WORDS = STOP_WORDS | set(ast.literal_eval(entity_stop_words_str) if entity_stop_words_str else [
+    'true', 'false', 'yes', 'no', 'not', 'and', 'or', 'with', 'all', 'any', 'every', 'list', 'many', 'much', 'how',
+    'when', 'where', 'there', 'this', 'that', 'it', 'has', 'have', 'new', 'old', 'main', 'end', 'life', 'model', 'number',
+    'asset', 'assets', 'location', 'locations', 'category', 'manufacturer', 'made', 'makes',
+])
+
+def trigrams(value):
+    value = f"  {value} "
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+def entity_text(value):
+    return " ".join(re.sub(r"[^\w#.\-/]+", " ", str(value).lower()).split())
+
+class EntityIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (entries, postings, memo), replaced whole on refresh and never changed after, so lookups read it without the lock.
+        self.index = ({}, {}, OrderedDict())
+        self.ready = False
+        self.refreshes = 0
+        self.refresh_seconds = 0.0
+        self.lookups = 0
+        self.resolved = 0
+        self.thread = None
+
+    def load(self, keys):
+        entries = {key: frozenset(trigrams(entity_text(key[1]))) for key in keys}
+        postings = {}
+        for key, grams in entries.items():
+            for gram in grams:
+                postings.setdefault(gram, []).append(key)
+        previous = self.index[0]
+        self.index = (entries, {gram: tuple(keys) for gram, keys in postings.items()}, OrderedDict())
+        self.ready = True
+        return len(entries.keys() - previous.keys()), len(previous.keys() - entries.keys())
+
+    def refresh(self):
+        started = time.perf_counter()
+        columns = [column for column in ENTITY_COLUMNS if column in view_columns()]
+        current = set()
+        with engine.connect() as connection:
+            for column in columns:
+                result = connection.exec_driver_sql(f"SELECT DISTINCT [{column}] FROM [{VIEW_NAME}] WHERE [{column}] IS NOT NULL")
+                current.update((column, str(row[0]).strip()) for row in result if str(row[0]).strip())
+        added, removed = self.load(current)
+        with self.lock:
+            self.refreshes += 1
+            self.refresh_seconds = time.perf_counter() - started
+        logger.info(f"Entity index refreshed: {added} added, {removed} removed, {len(current)} values in {self.refresh_seconds:.3f}s.")
+
+    def best_matches(self, mention, index=None):
+        entries, postings, _ = index or self.index
+        grams = trigrams(mention)
+        # Prefix filter: a value scoring at least the threshold shares at least that fraction of the mention's trigrams,
+        # so it has to contain one of the rarest few, and the common ones ("the", " fr") never need scanning.
+        needed = math.ceil(ENTITY_MATCH_THRESHOLD * len(grams))
+        rarest = sorted(grams, key=lambda gram: len(postings.get(gram, ())))[:len(grams) - needed + 1]
+        candidates = {key for gram in rarest for key in postings.get(gram, ())}
+        matches = []
+        for key in candidates:
+            shared = len(grams & entries[key])
+            score = shared / (len(grams) + len(entries[key]) - shared)
+            if score >= ENTITY_MATCH_THRESHOLD:
+                matches.append((score, key))
+        if not matches:
+            return 0.0, []
+        # An exact value settles the mention; otherwise every value over the threshold is a candidate, not just the top ties.
+        exact = sorted(key for _, key in matches if entity_text(key[1]) == mention)
+        if exact:
+            return 1.0, exact
+        return max(score for score, _ in matches), [key for _, key in sorted(matches, reverse=True)]
+
+    def resolve(self, question):
+        # The template slots, the prompt hint and exports all resolve the same question, so recent results are kept per index.
+        index = self.index
+        text = entity_text(question)
+        with self.lock:
+            self.lookups += 1
+            entities = index[2].get(text)
+            if entities is not None:
+                index[2].move_to_end(text)
+        if entities is None:
+            entities = self.resolve_text(text, index)
+            with self.lock:
+                index[2][text] = entities
+                while len(index[2]) > ENTITY_MEMO_SIZE:
+                    index[2].popitem(last=False)
+        if entities:
+            with self.lock:
+                self.resolved += 1
+        return entities
+
+    def resolve_text(self, text, index):
+        if not self.ready:
+            return []
+        words = text.split()
+        candidates = []
+        for size in range(min(ENTITY_MAX_SPAN, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                span = words[start:start + size]
+                if all(word in ENTITY_STOP_WORDS for word in span):
+                    continue
+                score, keys = self.best_matches(" ".join(span), index)
+                if keys:
+                    weight = score * sum(word not in ENTITY_STOP_WORDS for word in span)
+                    candidates.append((weight, score, size, start, " ".join(span), keys))
+
+        # Prefer the match that explains the most content words, so "ice machin" beats a perfect "ice".
+        used = set()
+        entities = []
+        for _, score, size, start, mention, keys in sorted(candidates, key=lambda c: (-c[0], -c[1])):
+            positions = set(range(start, start + size))
+            if positions & used:
+                continue
+            used |= positions
+            ambiguous = len({value for _, value in keys}) > 1
+            for column, value in keys:
+                entities.append({'mention': mention, 'column': column, 'value': value, 'score': round(score, 3), 'ambiguous': ambiguous})
+        return entities
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Entity index refresh failed: {e}")
+            if ENTITY_REFRESH_INTERVAL <= 0:
+                return
+            time.sleep(ENTITY_REFRESH_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='entity-index', daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        entries, postings, memo = self.index
+        with self.lock:
+            return {
+                'ready': self.ready,
+                'values': len(entries),
+                'trigrams': len(postings),
+                'memo': len(memo),
+                'refreshes': self.refreshes,
+                'refresh_ms': round(self.refresh_seconds * 1000, 1),
+                'lookups': self.lookups,
+                'resolved': self.resolved,
+            }
+
+entity_index = EntityIndex()
+
+TEMPLATE_FAST_PATH = os.getenv('TEMPLATE_FAST_PATH', 'true').lower() in ('1', 'true', 'yes')
+TEMPLATES_PATH = os.getenv('TEMPLATES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_templates.json'))
+TEMPLATE_ROW_LIMIT = int(os.getenv('TEMPLATE_ROW_LIMIT', '10'))
+
+class TemplateLibrary:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.attributes = {}
+        self.templates = []
+        self.lookups = 0
+        self.hits = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as templates_file:
+                library = json.load(templates_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Query templates not loaded from {self.path}: {e}")
+            return
+        self.attributes = {name.lower(): columns for name, columns in library.get('attributes', {}).items()}
+        # Longest names first, so "end of life of the deep fryer" splits after "end of life" rather than "end".
+        names = sorted(set(self.attributes) | {column.lower() for column in view_columns()}, key=len, reverse=True)
+        attributes = "|".join(re.escape(name) for name in names)
+        self.templates = [
+            dict(template, patterns=[re.compile(pattern.replace('{attributes}', attributes)) for pattern in template['patterns']])
+            for template in library.get('templates', [])
+        ]
+        logger.info(f"Loaded {len(self.templates)} query templates from {self.path}.")
+
+    def attribute_columns(self, attribute):
+        attribute = " ".join(attribute.split())
+        columns = self.attributes.get(attribute)
+        if columns is None:
+            columns = [column for column in view_columns() if column.lower() == attribute]
+        return [column for column in columns if column in view_columns()]
+
+    def resolve_slot(self, text, allowed_columns, question):
+        # Reuses the whole question's entities, keeping the mentions that lie inside this slot.
+        text = entity_text(text)
+        content = {word for word in text.split() if word not in STOP_WORDS}
+        entities = [entity for entity in entity_index.resolve(question) if f" {entity['mention']} " in f" {text} "]
+        for column in allowed_columns:
+            matches = [entity for entity in entities if entity['column'] == column]
+            covered = {word for entity in matches for word in entity['mention'].split()}
+            if matches and len({entity['value'] for entity in matches}) == 1 and content <= covered:
+                return column, matches[0]['value']
+        return None
+
+    def match(self, user_query):
+        question = " ".join(user_query.lower().strip().rstrip('?.!').split())
+        for template in self.templates:
+            for pattern in template['patterns']:
+                found = pattern.match(question)
+                if found:
+                    rendered = self.render(template, found.groupdict(), question)
+                    if rendered is not None:
+                        return template['name'], rendered[0], rendered[1]
+        return None
+
+    def render(self, template, slots, question):
+        replacements = {
+            'top': f"TOP {TEMPLATE_ROW_LIMIT}" if db.dialect == 'mssql' else "",
+            'limit': "" if db.dialect == 'mssql' else f"LIMIT {TEMPLATE_ROW_LIMIT}",
+        }
+        parameters = {}
+        if 'attribute' in slots:
+            columns = self.attribute_columns(slots.pop('attribute'))
+            if not columns:
+                return None
+            replacements['attribute'] = ", ".join(f"[{column}]" for column in columns)
+        for slot, allowed_columns in template.get('slots', {}).items():
+            if not slots.get(slot):
+                return None
+            resolved = self.resolve_slot(slots[slot], allowed_columns, question)
+            if resolved is None:
+                return None
+            replacements[f"{slot}_column"] = f"[{resolved[0]}]"
+            parameters[slot] = resolved[1]
+        return " ".join(template['sql'].format(**replacements).split()), parameters
+
+    def record(self, name):
+        with self.lock:
+            self.lookups += 1
+            if name is not None:
+                self.hits[name] = self.hits.get(name, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            hits = sum(self.hits.values())
+            return {
+                'templates': len(self.templates),
+                'lookups': self.lookups,
+                'hits': hits,
+                'hit_rate': round(hits / self.lookups, 4) if self.lookups else 0.0,
+                'by_template': dict(self.hits),
+            }
+
+template_library = TemplateLibrary(TEMPLATES_PATH)
+schema_snapshot.listeners.append(template_library.load)
+
+def answer_from_template(user_query, emit=ignore_event, answer_mode='auto'):
+    with metrics.stage('template_match'):
+        matched = template_library.match(user_query) if TEMPLATE_FAST_PATH and template_library.templates else None
+    template_library.record(matched[0] if matched else None)
+    if matched is None:
+        return None
+    name, sql, parameters = matched
+    logger.info(f"Answering user query with template {name}: {user_query}")
+    emit('template_matched', {'template': name, 'sql': sql, 'parameters': parameters})
+    columns, rows = execute_sql(sql, parameters)
+    emit('rows_fetched', {'count': len(rows)})
+    input_text = f"{PROMPT.format(question=user_query)}\n{SQL_QUERY}"
+    return synthesize_answer(input_text, sql, columns, rows, emit, 'direct' if answer_mode == 'auto' else answer_mode)
+
+FEWSHOT_MODE = os.getenv('FEWSHOT_MODE', 'dynamic').lower()
+FEWSHOT_EXAMPLES_PATH = os.getenv('FEWSHOT_EXAMPLES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fewshot_examples.jsonl'))
+FEWSHOT_K = int(os.getenv('FEWSHOT_K', '3'))
+FEWSHOT_TOKEN_BUDGET = int(os.getenv('FEWSHOT_TOKEN_BUDGET', '300'))
+FEWSHOT_MIN_SIMILARITY = float(os.getenv('FEWSHOT_MIN_SIMILARITY', '0.1'))
+FEWSHOT_MAX_EXAMPLES = int(os.getenv('FEWSHOT_MAX_EXAMPLES', '500'))
+FEWSHOT_DIMENSIONS = 2 ** 18
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English prose and SQL.
+    return len(text) // 4 + 1
+
+def question_features(question):
+    words = normalize_question(question).split()
+    grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    grams += [f"#{gram}" for word in words for gram in trigrams(word)]
+    features = {}
+    for gram in grams:
+        feature = zlib.crc32(gram.encode()) % FEWSHOT_DIMENSIONS
+        features[feature] = features.get(feature, 0) + 1
+    return features
+
+class FewShotLibrary:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.examples = OrderedDict()
+        self.vectors = []
+        self.idf = {}
+        self.dirty = True
+        self.calls = {}
+
+    def load(self):
+        try:
+            with open(self.path) as examples_file:
+                for line in examples_file:
+                    if line.strip():
+                        example = json.loads(line)
+                        self.add(example['question'], example['sql'])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Few-shot examples not loaded from {self.path}: {e}")
+        for question, sql in plan_store.top_plans(FEWSHOT_MAX_EXAMPLES):
+            self.add(question, sql)
+        logger.info(f"Few-shot library holds {len(self.examples)} examples.")
+
+    def add(self, question, sql):
+        key = normalize_question(question)
+        with self.lock:
+            if key not in self.examples and len(self.examples) >= FEWSHOT_MAX_EXAMPLES:
+                return
+            self.examples[key] = (question, " ".join(sql.split()))
+            self.dirty = True
+
+    def vectorize(self, features):
+        vector = {feature: count * self.idf.get(feature, 0.0) for feature, count in features.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {feature: weight / norm for feature, weight in vector.items()}
+
+    def rebuild(self):
+        documents = [question_features(question) for question, _ in self.examples.values()]
+        frequencies = {}
+        for features in documents:
+            for feature in features:
+                frequencies[feature] = frequencies.get(feature, 0) + 1
+        self.idf = {feature: math.log((1 + len(documents)) / (1 + count)) + 1 for feature, count in frequencies.items()}
+        self.vectors = [(self.vectorize(features), example) for features, example in zip(documents, self.examples.values())]
+        self.dirty = False
+
+    def select(self, user_query):
+        with self.lock:
+            if self.dirty:
+                self.rebuild()
+            query = self.vectorize(question_features(user_query))
+            scored = sorted(
+                ((sum(weight * vector.get(feature, 0.0) for feature, weight in query.items()), example) for vector, example in self.vectors),
+                key=lambda item: -item[0],
+            )
+        selected = []
+        budget = FEWSHOT_TOKEN_BUDGET
+        for score, (question, sql) in scored:
+            if len(selected) == FEWSHOT_K or score < FEWSHOT_MIN_SIMILARITY:
+                break
+            if normalize_question(question) == normalize_question(user_query):
+                continue
+            cost = estimate_tokens(question) + estimate_tokens(sql)
+            if cost <= budget:
+                selected.append((question, sql))
+                budget -= cost
+        return selected
+
+    def prompt(self, user_query, error):
+        if FEWSHOT_MODE != 'dynamic':
+            return PROMPT1.format(question=user_query, error=error), 'static'
+        selected = self.select(user_query)
+        if not selected:
+            return PROMPT1.format(question=user_query, error=error), 'static'
+        examples = "".join(f"- The Question :- {question}\n- The SQL Query :- {sql}\n" for question, sql in selected)
+        header = "- These are verified questions and SQL queries similar to the user question.\n- Assets and Locations are the main columns to query.\n"
+        return PROMPT1_RULES + header + examples + PROMPT1_QUESTION.format(question=user_query, error=error), 'dynamic'
+
+    def record(self, mode, prompt_text, ok):
+        with self.lock:
+            entry = self.calls.setdefault(mode, {'calls': 0, 'successes': 0, 'prompt_tokens': 0})
+            entry['calls'] += 1
+            entry['successes'] += int(ok)
+            entry['prompt_tokens'] += estimate_tokens(prompt_text)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': FEWSHOT_MODE,
+                'examples': len(self.examples),
+                'static_prompt_tokens': estimate_tokens(PROMPT1),
+                'by_mode': {
+                    mode: {
+                        'calls': entry['calls'],
+                        'success_rate': round(entry['successes'] / entry['calls'], 4),
+                        'avg_prompt_tokens': round(entry['prompt_tokens'] / entry['calls'], 1),
+                    }
+                    for mode, entry in self.calls.items()
+                },
+            }
+
+few_shot_library = FewShotLibrary(FEWSHOT_EXAMPLES_PATH)
+few_shot_library.load()
+
+def sql_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+def entity_hint(user_query):
+    by_column = OrderedDict()
+    broad = OrderedDict()
+    for entity in entity_index.resolve(user_query):
+        if entity['ambiguous']:
+            broad[(entity['column'], entity['mention'])] = True
+        elif entity['value'] not in by_column.get(entity['column'], []):
+            by_column.setdefault(entity['column'], []).append(entity['value'])
+    # Entities arrive best match first; past ENTITY_HINT_MAX_LINES the rest would only crowd the prompt.
+    exact = list(by_column.items())[:ENTITY_HINT_MAX_LINES]
+    broad = list(broad)[:ENTITY_HINT_MAX_LINES - len(exact)]
+    hint = ""
+    if exact:
+        lines = []
+        for column, values in exact:
+            if len(values) == 1:
+                lines.append(f"- [{column}] = {sql_literal(values[0])}")
+            else:
+                lines.append(f"- [{column}] IN ({', '.join(sql_literal(value) for value in values)})")
+        hint += (
+            "\nThese values from the question exist in the view. Filter on them with exact = or IN predicates "
+            "(combine columns with OR) instead of LIKE:\n" + "\n".join(lines) + "\n"
+        )
+    if broad:
+        # A mention that fits many values ("deep fryer" for Deep Fryer 1..39) would lose rows as an IN list.
+        lines = [f"- [{column}] LIKE {sql_literal('%' + mention + '%')}" for column, mention in broad]
+        hint += "\nThese phrases from the question match several values in the view. Filter on them with LIKE:\n" + "\n".join(lines) + "\n"
+    return hint
+
+def query_key(user_query, answer_mode='auto'):
+    key = normalize_question(user_query)
+    return key if answer_mode == 'auto' else f"{answer_mode}|{key}"
+
+def process_user_query(user_query, emit=ignore_event, answer_mode='auto'):
+    cache_key = query_key(user_query, answer_mode)
+    cached = answer_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Answer cache hit for user query: {user_query}")
+        emit('answer_cache_hit', {})
+        metrics.inc('requests_total', outcome='cache_hit')
+        return {"response": cached}
+
+    started = time.perf_counter()
+    outcome = 'error'
+    usage = None
+    try:
+        with get_openai_callback() as usage:
+            result = process_uncached_query(user_query, emit, answer_mode)
+        outcome = 'answered' if "response" in result else 'failed'
+    except DeadlineExceeded as e:
+        outcome = 'timeout'
+        logger.warning(f"User query ran out of time during {e.stage}: {user_query}")
+        raise
+    finally:
+        metrics.observe('request_seconds', time.perf_counter() - started, outcome=outcome)
+        metrics.inc('requests_total', outcome=outcome)
+        if usage is not None:
+            rate_limiter.charge(request_user.get(), usage.total_tokens)
+    if "response" in result:
+        answer_cache.put(cache_key, result["response"], time.perf_counter() - started, usage.total_tokens)
+    return result
+
+def cached_plan(plan_key):
+    # The plan store is only a shortcut: when its SQLite file is locked or unreadable the question is answered from scratch.
+    try:
+        return plan_store.get(plan_key)
+    except sqlite3.Error as e:
+        logger.warning(f"SQL plan cache lookup failed: {e}")
+        return None
+
+def remember_plan(plan_key, user_query, sql, examples=True):
+    # Runs after the answer is in hand, so a plan store that can't be written never costs the caller their answer.
+    try:
+        plan_store.put(plan_key, user_query, sql)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not save the SQL plan for user query {user_query}: {e}")
+    if examples:
+        few_shot_library.add(user_query, sql)
+
+def forget_plan(plan_key):
+    try:
+        plan_store.delete(plan_key)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not drop the failed SQL plan: {e}")
+
+def process_uncached_query(user_query, emit=ignore_event, answer_mode='auto'):
+    try:
+        answer = answer_from_template(user_query, emit, answer_mode)
+        if answer is not None:
+            return {"response": answer}
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"Template fast path failed, falling through to the chain: {e}")
+
+    plan_key = normalize_question(user_query)
+    sql = cached_plan(plan_key)
+    if sql is not None:
+        try:
+            logger.info(f"Reusing cached SQL plan for user query: {user_query}")
+            emit('plan_cache_hit', {'sql': sql})
+            return {"response": answer_from_sql(PROMPT.format(question=user_query), sql, emit, answer_mode)}
+        except DeadlineExceeded:
+            raise
+        except Exception as error:
+            logger.warning(f"Cached SQL plan failed, regenerating: {error}")
+            forget_plan(plan_key)
+
+    hint = entity_hint(user_query)
+    if hint:
+        emit('entities_resolved', {'hint': hint.strip()})
+    started = time.perf_counter()
     try:
         logger.info(f"Processing user query: {user_query}")
-        results = db_chain.invoke(PROMPT.format(question=user_query))
+        answer, sql = run_chain(PROMPT.format(question=user_query) + hint, emit, answer_mode)
+        path_stats.record('primary', True, time.perf_counter() - started)
+    except DeadlineExceeded:
+        path_stats.record('primary', False, time.perf_counter() - started)
+        raise
+    except Exception as e:
+        path_stats.record('primary', False, time.perf_counter() - started)
+        logger.warning(f"Error processing query: {e}")
+        failed_sql = getattr(e, 'sql', None)
+        error = first_line(e)
+    else:
+        remember_plan(plan_key, user_query, sql)
         logger.info("Query processed successfully.")
-        results_container.append({"response": results['result']})
-    except Exception as error:
-        logger.warning(f"Error processing query: {error}")
+        return {"response": answer}
+
+    if failed_sql and SQL_REPAIR_ATTEMPTS > 0:
+        try:
+            answer, sql = repair_chain(PROMPT.format(question=user_query) + hint, failed_sql, error, emit, answer_mode)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.warning(f"SQL repair failed: {e}")
+            error = first_line(e)
+        else:
+            remember_plan(plan_key, user_query, sql)
+            logger.info("Processed query with SQL repair.")
+            return {"response": answer}
+
+    started = time.perf_counter()
+    fallback_prompt, fewshot_mode = few_shot_library.prompt(user_query, error)
+    try:
+        emit('fallback', {'error': error, 'fewshot': fewshot_mode})
+        answer, sql = run_chain(fallback_prompt + hint, emit, answer_mode)
+    except Exception as e:
+        path_stats.record('fallback', False, time.perf_counter() - started)
+        few_shot_library.record(fewshot_mode, fallback_prompt, False)
+        if isinstance(e, DeadlineExceeded):
+            raise
+        logger.warning(f"Critical error: {e}")
+        return {'message': 'I dont understand your question please provide more details.', 'error': str(e)}
+    path_stats.record('fallback', True, time.perf_counter() - started)
+    few_shot_library.record(fewshot_mode, fallback_prompt, True)
+    remember_plan(plan_key, user_query, sql)
+    logger.info("Processed query with error handling.")
+    return {"response": answer}
+
+QUERY_QUEUE_SIZE = int(os.getenv('QUERY_QUEUE_SIZE', '40'))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '60'))
+MAX_REQUEST_TIMEOUT = float(os.getenv('MAX_REQUEST_TIMEOUT', '120'))
+# Extra time callers wait past the deadline so the worker can report which stage ran out of time.
+DEADLINE_GRACE = float(os.getenv('DEADLINE_GRACE', '1.0'))
+RETRY_AFTER = os.getenv('RETRY_AFTER', '2')
+
+RATE_LIMIT_REQUESTS_PER_MINUTE = float(os.getenv('RATE_LIMIT_REQUESTS_PER_MINUTE', '60'))
+RATE_LIMIT_TOKENS_PER_MINUTE = float(os.getenv('RATE_LIMIT_TOKENS_PER_MINUTE', '60000'))
+BATCH_WEIGHT = float(os.getenv('BATCH_WEIGHT', '0.25'))
+USER_MAX_QUEUED = int(os.getenv('USER_MAX_QUEUED', str(max(1, QUERY_QUEUE_SIZE // 2))))
+user_limits_str = os.getenv('USER_LIMITS')
+USER_LIMITS = ast.literal_eval(user_limits_str) if user_limits_str else {}
+admin_users_str = os.getenv('ADMIN_USERS')
+# Nobody is an admin unless named here, so list whoever refreshes MyAiView to let them call /v1/cache/invalidate.
+ADMIN_USERS = ast.literal_eval(admin_users_str) if admin_users_str else []
+
+class QueryBusy(Exception):
+    pass
+
+class RateLimited(Exception):
+    def __init__(self, limit, retry_after):
+        super().__init__(f"{limit} rate limit exceeded")
+        self.limit = limit
+        self.retry_after = retry_after
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount):
+        if self.capacity <= 0:
+            return 0.0
+        self.refill()
+        # A request larger than the bucket waits for a full bucket rather than forever.
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if self.capacity > 0:
+            self.refill()
+            self.level -= amount
+
+class RateLimiter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def entry(self, user):
+        entry = self.users.get(user)
+        if entry is None:
+            limits = dict({
+                'requests_per_minute': RATE_LIMIT_REQUESTS_PER_MINUTE,
+                'tokens_per_minute': RATE_LIMIT_TOKENS_PER_MINUTE,
+                'weight': 1.0,
+                'batch': False,
+            }, **USER_LIMITS.get(user, {}))
+            entry = self.users[user] = {
+                'limits': limits,
+                'requests': TokenBucket(limits['requests_per_minute']),
+                'tokens': TokenBucket(limits['tokens_per_minute']),
+                'admitted': 0,
+                'limited': 0,
+                'tokens_used': 0,
+            }
+        return entry
+
+    def admit(self, user, requests=1):
+        with self.lock:
+            entry = self.entry(user)
+            # LLM tokens are only known afterwards, so a user may start requests while any token budget is left.
+            for limit, amount in (('requests', requests), ('tokens', 1)):
+                wait = entry[limit].wait(amount)
+                if wait > 0:
+                    entry['limited'] += 1
+                    metrics.inc('rate_limited_total', user=user, limit=limit)
+                    raise RateLimited(limit, wait)
+            entry['requests'].take(requests)
+            entry['admitted'] += requests
+
+    def charge(self, user, tokens):
+        if not tokens:
+            return
+        with self.lock:
+            entry = self.entry(user)
+            entry['tokens'].take(tokens)
+            entry['tokens_used'] += tokens
+        metrics.inc('user_llm_tokens_total', tokens, user=user)
+
+    def weight(self, user, batch=False):
+        with self.lock:
+            limits = self.entry(user)['limits']
+        return limits['weight'] * (BATCH_WEIGHT if batch or limits['batch'] else 1.0)
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for user, entry in self.users.items():
+                entry['requests'].refill()
+                entry['tokens'].refill()
+                result[user] = {
+                    'limits': entry['limits'],
+                    'admitted': entry['admitted'],
+                    'limited': entry['limited'],
+                    'tokens_used': entry['tokens_used'],
+                    'requests_available': round(entry['requests'].level, 1),
+                    'tokens_available': round(entry['tokens'].level),
+                }
+            return result
+
+rate_limiter = RateLimiter()
+
+class QueryExpired(DeadlineExceeded):
+    def __init__(self):
+        super().__init__('queue')
+
+class QueryExecutor:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = []
+        self.sequence = 0
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.queued_by_user = {}
+        self.running_by_user = {}
+        self.pid = None
+        self.admitted = 0
+        self.running = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def start(self):
+        # Worker threads do not survive fork, so every process starts its own on first use.
+        self.pid = os.getpid()
+        for position in range(self.workers):
+            threading.Thread(target=self.work, name=f'query-{position}', daemon=True).start()
+
+    def submit(self, deadline, fn, *args, user=None, weight=1.0):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise QueryBusy()
+        future = Future()
+        with self.lock:
+            if self.queued_by_user.get(user, 0) >= USER_MAX_QUEUED:
+                self.rejected += 1
+                self.slots.release()
+                raise QueryBusy()
+            if self.pid != os.getpid():
+                self.start()
+            # Start-time fair queuing: each user's jobs are spaced 1/weight apart in virtual time,
+            # so a user with a deep backlog cannot push back someone who just arrived.
+            start = max(self.virtual_time, self.finish_tags.get(user, 0.0))
+            self.finish_tags[user] = start + 1.0 / weight
+            heapq.heappush(self.pending, (start, self.sequence, user, deadline, future, fn, args))
+            self.sequence += 1
+            self.queued_by_user[user] = self.queued_by_user.get(user, 0) + 1
+            self.admitted += 1
+            self.ready.notify()
+        future.add_done_callback(lambda _: self.release())
+        return future
+
+    def work(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.ready.wait()
+                start, _, user, deadline, future, fn, args = heapq.heappop(self.pending)
+                self.virtual_time = start
+                self.queued_by_user[user] -= 1
+                if not self.queued_by_user[user]:
+                    del self.queued_by_user[user]
+                if not self.pending:
+                    self.finish_tags.clear()
+                    self.virtual_time = 0.0
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.run(deadline, user, fn, *args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def run(self, deadline, user, fn, *args):
+        # Skip work whose caller has already given up while it sat in the queue.
+        if time.monotonic() >= deadline:
+            with self.lock:
+                self.expired += 1
+            raise QueryExpired()
+        with self.lock:
+            self.running += 1
+            self.running_by_user[user] = self.running_by_user.get(user, 0) + 1
+        deadline_token = request_deadline.set(deadline)
+        user_token = request_user.set(user)
+        try:
+            return fn(*args)
+        finally:
+            request_user.reset(user_token)
+            request_deadline.reset(deadline_token)
+            with self.lock:
+                self.running -= 1
+                self.running_by_user[user] -= 1
+                if not self.running_by_user[user]:
+                    del self.running_by_user[user]
+
+    def release(self):
+        with self.lock:
+            self.admitted -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'running': self.running,
+                'queued': self.admitted - self.running,
+                'rejected': self.rejected,
+                'expired': self.expired,
+            }
+
+    def users(self):
+        with self.lock:
+            return {
+                user: {'queued': self.queued_by_user.get(user, 0), 'running': self.running_by_user.get(user, 0)}
+                for user in set(self.queued_by_user) | set(self.running_by_user)
+            }
+
+query_executor = QueryExecutor(QUERY_WORKERS, QUERY_QUEUE_SIZE)
+
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def submit(self, key, start):
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, True
+            future = start()
+            self.calls[key] = future
+            self.leaders += 1
+        future.add_done_callback(lambda done: self.forget(key, done))
+        return future, False
+
+    def forget(self, key, future):
+        with self.lock:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': len(self.calls), 'leaders': self.leaders, 'coalesced': self.coalesced}
+
+in_flight = SingleFlight()
+
+def submit_user_query(user_query, deadline, answer_mode='auto', user=None, weight=1.0):
+    future, coalesced = in_flight.submit(
+        query_key(user_query, answer_mode),
+        lambda: query_executor.submit(deadline, process_user_query, user_query, ignore_event, answer_mode, user=user, weight=weight),
+    )
+    if coalesced:
+        logger.info(f"Coalesced user query onto in-flight execution: {user_query}")
+    return future
+
+def request_timeout(value):
+    try:
+        timeout = float(value) if value else REQUEST_TIMEOUT
+    except ValueError:
+        timeout = REQUEST_TIMEOUT
+    return min(max(timeout, 1.0), MAX_REQUEST_TIMEOUT)
+
+BATCH_PARALLELISM = int(os.getenv('BATCH_PARALLELISM', '4'))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '50'))
+
+def answer_mode_option(value):
+    value = (value or 'auto').lower()
+    return value if value in ANSWER_MODES else 'auto'
+
+def run_batch(questions, deadline, answer_mode='auto', user=None, weight=1.0):
+    slots = threading.Semaphore(BATCH_PARALLELISM)
+    pending = []
+    for question in questions:
+        if not slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            pending.append((question, None, {'message': 'Request timed out.', 'error': 'timeout', 'stage': 'queue'}))
+            continue
+        timing = {'started': time.perf_counter()}
+        try:
+            future = submit_user_query(question, deadline, answer_mode, user, weight)
+        except QueryBusy:
+            slots.release()
+            pending.append((question, None, {'message': 'Server is busy, please retry shortly.', 'error': 'busy'}))
+            continue
+
+        def finished(_, timing=timing):
+            timing['elapsed'] = time.perf_counter() - timing['started']
+            slots.release()
+
+        future.add_done_callback(finished)
+        pending.append((question, (future, timing), None))
+
+    results = {}
+    for question, submitted, failure in pending:
+        if failure is not None:
+            results[question] = dict(failure, elapsed=0.0)
+            continue
+        future, timing = submitted
+        try:
+            result = dict(future.result(timeout=max(deadline - time.monotonic(), 0) + DEADLINE_GRACE))
+        except DeadlineExceeded as e:
+            result = {'message': 'Request timed out.', 'error': 'timeout', 'stage': e.stage}
+        except FutureTimeoutError:
+            result = {'message': 'Request timed out.', 'error': 'timeout', 'stage': 'unknown'}
+        except Exception as e:
+            logger.warning(f"Batch item failed: {e}")
+            result = {'message': 'Internal server error.', 'error': str(e)}
+        result['elapsed'] = round(timing.get('elapsed', time.perf_counter() - timing['started']), 3)
+        results[question] = result
+    return results
+
+def format_event(stream_format, event, data):
+    if stream_format == 'sse':
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps(dict(data, event=event)) + "\n"
+
+def stream_user_query(user_query, timeout, stream_format, answer_mode='auto', user=None, weight=1.0):
+    events = queue.Queue()
+    deadline = time.monotonic() + timeout
+    future = query_executor.submit(deadline, process_user_query, user_query, lambda event, data: events.put((event, data)), answer_mode, user=user, weight=weight)
+    future.add_done_callback(lambda _: events.put(None))
+
+    def generate():
+        yield format_event(stream_format, 'accepted', {'user_query': user_query})
+        while True:
+            try:
+                item = events.get(timeout=max(deadline - time.monotonic(), 0) + DEADLINE_GRACE)
+            except queue.Empty:
+                logger.warning(f"Streamed user query timed out after {timeout} seconds.")
+                yield format_event(stream_format, 'timeout', timeout_body(timeout, 'unknown'))
+                return
+            if item is None:
+                break
+            yield format_event(stream_format, *item)
+        try:
+            yield format_event(stream_format, 'result', future.result())
+        except DeadlineExceeded as e:
+            yield format_event(stream_format, 'timeout', timeout_body(timeout, e.stage))
+        except Exception as e:
+            logger.warning(f"Error streaming query: {e}")
+            yield format_event(stream_format, 'error', {'message': 'Internal server error.'})
+
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def busy_response():
+    return jsonify({'message': 'Server is busy, please retry shortly.'}), 503, {'Retry-After': RETRY_AFTER}
+
+def rate_limited_response(error):
+    retry_after = max(1, math.ceil(error.retry_after))
+    return jsonify({'message': f'Too many {error.limit}, please retry later.', 'limit': error.limit, 'retry_after': retry_after}), 429, {'Retry-After': str(retry_after)}
+
+def timeout_body(timeout, stage):
+    return {'message': 'Request timed out.', 'error': 'timeout', 'stage': stage, 'timeout': timeout}
+
+EXPORT_FORMATS = {'json': 'application/json', 'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '1000'))
+EXPORT_MAX_PAGE_SIZE = int(os.getenv('EXPORT_MAX_PAGE_SIZE', '10000'))
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '500'))
+EXPORT_MAX_ROWS = int(os.getenv('EXPORT_MAX_ROWS', '1000000'))
+EXPORT_GZIP_LEVEL = int(os.getenv('EXPORT_GZIP_LEVEL', '6'))
+EXPORT_QUEUE_BATCHES = int(os.getenv('EXPORT_QUEUE_BATCHES', '4'))
+EXPORT_CURSOR_SECRET = (os.getenv('EXPORT_CURSOR_SECRET') or hashlib.sha256(f"{url}|{API_KEY}".encode()).hexdigest()).encode()
+
+class InvalidCursor(Exception):
+    pass
+
+def export_sql(user_query):
+    # The SQL the answer path would run for this question: template, cached plan, or a fresh generation without the answer step.
+    matched = template_library.match(user_query) if TEMPLATE_FAST_PATH and template_library.templates else None
+    if matched is not None:
+        return matched[1], matched[2], None
+    plan_key = normalize_question(user_query)
+    sql = cached_plan(plan_key)
+    if sql is not None:
+        return sql, {}, None
+    usage = None
+    try:
+        with get_openai_callback() as usage:
+            sql = check_sql(generate_sql(f"{PROMPT.format(question=user_query)}{entity_hint(user_query)}\n{SQL_QUERY}"))
+    finally:
+        if usage is not None:
+            rate_limiter.charge(request_user.get(), usage.total_tokens)
+    return sql, {}, plan_key
+
+def drop_order_by(code):
+    # Cuts the statement's own ORDER BY, function calls and all, but leaves the ones nested in subqueries.
+    bare = re.sub(r"\[[^\]]*\]", lambda match: "_" * len(match.group(0)), code)
+    depth, cut = 0, None
+    for match in re.finditer(r"[()]|\bORDER\s+BY\b", bare, re.I):
+        if match.group(0) == "(":
+            depth += 1
+        elif match.group(0) == ")":
+            depth -= 1
+        elif not depth:
+            cut = match.start()
+    return code if cut is None else code[:cut].rstrip()
+
+def strip_row_limits(sql, keep_order=False):
+    # Drops the TOP/OFFSET/LIMIT and final ORDER BY the prompt asks for, or returns None when some other limit remains.
+    # keep_order leaves the ORDER BY for statements that run as they are rather than wrapped for paging.
+    code, literals = mask_literals(sql)
+    code = re.sub(r"^(\s*SELECT\s+(?:DISTINCT\s+)?)TOP\s*\(?\s*\d+\s*\)?\s+(?!PERCENT\b|WITH\s+TIES\b)", r"\1", code, flags=re.I)
+    code = re.sub(r"\s+OFFSET\s+\d+\s+ROWS?(?:\s+FETCH\s+(?:NEXT|FIRST)\s+\d+\s+ROWS?\s+ONLY)?\s*$", "", code, flags=re.I)
+    code = re.sub(r"\s+LIMIT\s+\d+(?:\s+OFFSET\s+\d+)?\s*$", "", code, flags=re.I)
+    if not keep_order:
+        code = drop_order_by(code)
+    if re.search(r"\bTOP\b|\bOFFSET\b|\bFETCH\b|\bLIMIT\b", re.sub(r"\[[^\]]*\]", "[]", code), re.I):
+        return None
+    return restore_literals(code, literals)
+
+def prepare_export(user_query):
+    sql, parameters, plan_key = export_sql(user_query)
+    base = strip_row_limits(sql)
+    columns = None
+    if base is not None:
+        try:
+            columns, _ = run_statement(engine, f"SELECT * FROM ({base}) AS export_rows WHERE 1 = 0", parameters)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.info(f"Export query can't be wrapped for keyset paging, streaming it unpaged: {first_line(e)}")
+    if columns is None or len(set(columns)) != len(columns):
+        # Unpaged exports still run without the prompt's row limit, keeping its ORDER BY since nothing wraps them.
+        base, columns = strip_row_limits(sql, keep_order=True) or sql, None
+    elif plan_key is not None:
+        remember_plan(plan_key, user_query, sql, examples=False)
+    logger.info(f"Exporting {'paged' if columns else 'unpaged'} rows for user query: {user_query}")
+    return {'user': request_user.get(), 'sql': base, 'parameters': parameters, 'columns': columns, 'after': None, 'skip': 0}
+
+def export_literal(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return "'" + value.isoformat(sep=' ', timespec='milliseconds' if value.microsecond % 1000 == 0 else 'microseconds') + "'"
+    if isinstance(value, (datetime.date, datetime.time)):
+        return "'" + value.isoformat() + "'"
+    if isinstance(value, (bytes, bytearray)):
+        return f"0x{value.hex()}" if db.dialect == 'mssql' else f"X'{value.hex()}'"
+    return ("N" if db.dialect == 'mssql' else "") + sql_literal(str(value))
+
+def export_key(row):
+    return [export_literal(value) for value in row]
+
+def keyset_predicate(columns, after, escape_colons):
+    # Rows at or after the last key sent in ORDER BY 1..n order. SQL Server and SQLite both sort NULLs first,
+    # so a NULL key matches IS NULL on equality and everything non-NULL after it.
+    names = [f"[{column.replace(']', ']]')}]" for column in columns]
+    if escape_colons:
+        after = [None if value is None else value.replace(':', '\\:') for value in after]
+    terms = []
+    for position, (name, value) in enumerate(zip(names, after)):
+        equal = [f"{prior} IS NULL" if key is None else f"{prior} = {key}" for prior, key in zip(names[:position], after[:position])]
+        if position == len(names) - 1:
+            last = "1 = 1" if value is None else f"{name} >= {value}"
+        else:
+            last = f"{name} IS NOT NULL" if value is None else f"{name} > {value}"
+        terms.append("(" + " AND ".join(equal + [last]) + ")")
+    return " OR ".join(terms)
+
+def export_statement(state, limit):
+    where = ""
+    if state['after'] is not None:
+        where = " WHERE " + keyset_predicate(state['columns'], state['after'], bool(state['parameters']))
+    order = ", ".join(str(position) for position in range(1, len(state['columns']) + 1))
+    sql = f"SELECT * FROM ({state['sql']}) AS export_rows{where} ORDER BY {order}"
+    if db.dialect == 'mssql':
+        return f"{sql} OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY"
+    return f"{sql} LIMIT {limit}"
+
+def fetch_export(sql, parameters, timeout):
+    # Yields the column names, then row batches straight off the DB cursor; each page holds one pooled connection.
+    started = time.perf_counter()
+    try:
+        with engine.connect() as connection, statement_deadline(connection, 'export', time.monotonic() + timeout):
+            connection.execution_options(stream_results=True, max_row_buffer=EXPORT_FETCH_SIZE)
+            result = execute_statement(connection, sql, parameters)
+            yield list(result.keys())
+            while True:
+                rows = result.fetchmany(EXPORT_FETCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        metrics.observe('stage_seconds', time.perf_counter() - started, stage='export')
+
+def export_page(state, page_size, timeout):
+    # Yields the column names, then row batches for one page, and leaves state positioned after the last row or marked done.
+    # Duplicate rows tie on every key column, so the cursor also counts how many copies of the last key were already sent.
+    # An unpaged query can't resume, so it is marked truncated when rows remain past page_size.
+    paged = state['columns'] is not None
+    sql = export_statement(state, page_size + state['skip']) if paged else state['sql']
+    batches = fetch_export(sql, state['parameters'], timeout)
+    try:
+        yield next(batches)
+        skip, count, last, run, more = state['skip'], 0, None, 0, False
+        for batch in batches:
+            rows = []
+            for row in batch:
+                if count >= page_size:
+                    more = True
+                    break
+                if skip and export_key(row) == state['after']:
+                    skip -= 1
+                    continue
+                skip = 0
+                if last is not None and tuple(row) == tuple(last):
+                    run += 1
+                else:
+                    run = state['skip'] + 1 if last is None and state['after'] is not None and export_key(row) == state['after'] else 1
+                    last = row
+                rows.append(row)
+                count += 1
+            if rows:
+                yield rows
+            if more or (paged and count >= page_size):
+                break
+    finally:
+        batches.close()
+    if paged and count >= page_size:
+        state['after'], state['skip'] = export_key(last), run
+    else:
+        state['done'] = True
+        state['truncated'] = more
+
+def queued_export_page(state, page_size, timeout, wait=False):
+    # Runs export_page on a query worker so exports go through the same admission control and fair queuing as answers.
+    # Batches come back through a small queue, and the worker stops once the response is closed or the page deadline passes.
+    deadline = time.monotonic() + timeout
+    user = state['user']
+    batches = queue.Queue(EXPORT_QUEUE_BATCHES)
+    closed = threading.Event()
+
+    def produce():
+        pages = export_page(state, page_size, timeout)
         try:
-            error = str(error).split('\n')[0]
-            results = db_chain.invoke(PROMPT1.format(question=user_query, error=error))
-            logger.info("Processed query with error handling.")
-            results_container.append({"response": results['result']})
+            for item in pages:
+                while not closed.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        time_left()
+                else:
+                    return
+        finally:
+            pages.close()
+
+    while True:
+        try:
+            future = query_executor.submit(deadline, produce, user=user, weight=rate_limiter.weight(user))
+            break
+        except QueryBusy:
+            # Later pages of a stream already under way wait for room rather than cutting it off.
+            if not wait or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+    try:
+        while True:
+            try:
+                yield batches.get(timeout=0.1)
+            except queue.Empty:
+                if future.done() and batches.empty():
+                    future.result()
+                    return
+                if time.monotonic() >= deadline + DEADLINE_GRACE:
+                    raise DeadlineExceeded('export')
+    finally:
+        closed.set()
+
+def encode_cursor(state):
+    payload = base64.urlsafe_b64encode(zlib.compress(json.dumps(state, separators=(',', ':')).encode())).decode().rstrip('=')
+    signature = hmac.new(EXPORT_CURSOR_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{payload}.{signature}"
+
+def decode_cursor(cursor, user):
+    payload, _, signature = cursor.partition('.')
+    if not hmac.compare_digest(signature, hmac.new(EXPORT_CURSOR_SECRET, payload.encode(), hashlib.sha256).hexdigest()[:32]):
+        raise InvalidCursor("Export cursor is invalid or has been tampered with.")
+    state = json.loads(zlib.decompress(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))))
+    if state.get('user') != user:
+        raise InvalidCursor("Export cursor belongs to another user.")
+    return state
+
+def export_rows_chunks(state, export_format, page_size, timeout):
+    # Walks every page from the cursor position; the first chunk is yielded once the first page's query is running.
+    # Unpaged queries stream in one go. An NDJSON export cut off at EXPORT_MAX_ROWS ends with a line saying so.
+    sent = 0
+    header = True
+    try:
+        while not state.get('done') and sent < EXPORT_MAX_ROWS:
+            limit = page_size if state['columns'] is not None else EXPORT_MAX_ROWS
+            pages = queued_export_page(state, min(limit, EXPORT_MAX_ROWS - sent), timeout, wait=not header)
+            columns = next(pages)
+            if header:
+                header = False
+                yield export_csv([columns]) if export_format == 'csv' else ""
+            for rows in pages:
+                sent += len(rows)
+                if export_format == 'csv':
+                    yield export_csv([[replica_value(value) for value in row] for row in rows])
+                else:
+                    yield "".join(json.dumps(dict(zip(columns, map(replica_value, row)))) + "\n" for row in rows)
+        if state.get('truncated') or not state.get('done'):
+            logger.warning(f"Export stopped at EXPORT_MAX_ROWS={EXPORT_MAX_ROWS} rows.")
+            metrics.inc('export_truncated_total', format=export_format)
+            if export_format == 'ndjson':
+                yield json.dumps({'truncated': True, 'count': sent, 'next_cursor': None if state.get('done') else encode_cursor(state)}) + "\n"
+    except Exception as e:
+        # Headers are already sent, so the only way to signal a failed export is to break the stream.
+        logger.warning(f"Export stream failed after {sent} rows: {e}")
+        raise
+    finally:
+        metrics.inc('export_rows_total', sent, format=export_format)
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+def gzip_chunks(chunks):
+    # Flushes after every batch so the client can decompress rows as they arrive.
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+def export_response(chunks, export_format, compress):
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}
+    if export_format == 'csv':
+        headers['Content-Disposition'] = 'attachment; filename="export.csv"'
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        chunks = gzip_chunks(chunks)
+    return Response(chunks, mimetype=EXPORT_FORMATS[export_format], headers=headers)
+
+def export_page_size(value):
+    try:
+        page_size = int(value) if value else EXPORT_PAGE_SIZE
+    except ValueError:
+        page_size = EXPORT_PAGE_SIZE
+    return min(max(page_size, 1), EXPORT_MAX_PAGE_SIZE)
+
+worker_lock = threading.Lock()
+worker_state = {'pid': None, 'warm_connections': 0, 'warmup_ms': 0.0, 'error': None, 'schema_generation': 0}
+
+def warm_pool(count):
+    connections = []
+    try:
+        for _ in range(count):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.exec_driver_sql("SELECT 1")
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+def init_worker():
+    # Runs once per process after fork: connections and background threads do not survive fork, shared read-only state does.
+    with worker_lock:
+        if worker_state['pid'] == os.getpid():
+            return
+        engine.dispose(close=False)
+        schema_snapshot.start()
+        entity_index.start()
+        if REPLICA_ENABLED:
+            replica.start()
+        started = time.perf_counter()
+        try:
+            worker_state['warm_connections'] = warm_pool(DB_POOL_WARMUP)
+            worker_state['error'] = None
         except Exception as e:
-            logger.warning(f"Critical error: {e}")
-            results_container.append({'message': 'I dont understand your question please provide more details.', 'error': str(e)})
+            logger.warning(f"Connection pool warmup failed: {e}")
+            worker_state['error'] = first_line(e)
+        worker_state['warmup_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        worker_state['pid'] = os.getpid()
+        logger.info(f"Worker {os.getpid()} initialized, {worker_state['warm_connections']} connections warmed in {worker_state['warmup_ms']}ms.")
+
+def create_app():
+    # Module import builds the shared read-only state (config, prompts, schema snapshot, templates, few-shot library)
+    # so gunicorn can preload it in the master; per-worker state is set up by init_worker after fork.
+    app.config['DEBUG'] = os.getenv('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes')
+    return app
+
+@app.before_request
+def ensure_worker():
+    if worker_state['pid'] != os.getpid():
+        init_worker()
+    generation = plan_store.generation('schema')
+    if generation != worker_state['schema_generation']:
+        worker_state['schema_generation'] = generation
+        schema_snapshot.reload()
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok', 'pid': os.getpid()}), 200
+
+READYZ_DB_TIMEOUT = float(os.getenv('READYZ_DB_TIMEOUT', '2'))
+readiness_probe = ThreadPoolExecutor(1, thread_name_prefix='readyz')
+
+def probe_database():
+    with engine.connect() as connection:
+        connection.exec_driver_sql("SELECT 1")
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    checks = {
+        'initialized': worker_state['pid'] == os.getpid(),
+        'schema_snapshot': schema_snapshot.data is not None,
+        'accepting': query_executor.stats()['queued'] < QUERY_QUEUE_SIZE,
+    }
+    saturated = engine.pool.checkedout() >= DB_POOL_SIZE + DB_MAX_OVERFLOW
+    if saturated:
+        # Every connection is busy running queries, which already shows the database is reachable;
+        # waiting for one would stall the probe for pool_timeout and get a busy worker marked down.
+        checks['database'] = True
+    else:
+        try:
+            readiness_probe.submit(probe_database).result(timeout=READYZ_DB_TIMEOUT)
+            checks['database'] = True
+        except FutureTimeoutError:
+            logger.warning(f"Readiness check got no database answer within {READYZ_DB_TIMEOUT} seconds.")
+            checks['database'] = False
+        except Exception as e:
+            logger.warning(f"Readiness check could not reach the database: {e}")
+            checks['database'] = False
+    ready = all(checks.values())
+    return jsonify({
+        'status': 'ready' if ready else 'not ready',
+        'checks': checks,
+        'pool': {
+            'size': engine.pool.size(),
+            'checked_out': engine.pool.checkedout(),
+            'saturated': saturated,
+            'warm_connections': worker_state['warm_connections'],
+        },
+        'entities_ready': entity_index.stats()['ready'],
+    }), 200 if ready else 503
 
 @app.route('/v1/sql', methods=['POST'])
 @auth.login_required
@@ -137,20 +2808,276 @@ def user_query():
             logger.warning("User query not provided.")
             return jsonify({'message': 'Please provide a question in the question field.'}), 400
 
-        results_container = []
-        user_thread = threading.Thread(target=process_user_query, args=(user_query, results_container))
-        user_thread.start()
-        user_thread.join()  
-        
-        return jsonify(results_container[0]), 200
+        user = auth.current_user()
+        try:
+            rate_limiter.admit(user)
+        except RateLimited as e:
+            logger.warning(f"Rate limiting user {user} on {e.limit}.")
+            return rate_limited_response(e)
+        weight = rate_limiter.weight(user)
+
+        timeout = request_timeout(request.form.get("timeout"))
+        answer_mode = answer_mode_option(request.form.get("answer_mode"))
+        stream_format = request.form.get("stream", "").lower()
+        if not stream_format and request.accept_mimetypes.best == 'text/event-stream':
+            stream_format = 'sse'
+        if stream_format in ('sse', 'ndjson'):
+            try:
+                return stream_user_query(user_query, timeout, stream_format, answer_mode, user, weight)
+            except QueryBusy:
+                logger.warning("Query queue is full, rejecting streamed request.")
+                return busy_response()
+
+        try:
+            future = submit_user_query(user_query, time.monotonic() + timeout, answer_mode, user, weight)
+        except QueryBusy:
+            logger.warning("Query queue is full, rejecting request.")
+            return busy_response()
+
+        try:
+            return jsonify(future.result(timeout=timeout + DEADLINE_GRACE)), 200
+        except DeadlineExceeded as e:
+            logger.warning(f"User query timed out after {timeout} seconds during {e.stage}.")
+            return jsonify(timeout_body(timeout, e.stage)), 504
+        except FutureTimeoutError:
+            logger.warning(f"User query timed out after {timeout} seconds.")
+            return jsonify(timeout_body(timeout, 'unknown')), 504
 
     except Exception as e:
-        logger.warning(f"Error starting thread: {e}")
+        logger.warning(f"Error processing request: {e}")
         return jsonify({'message': 'Internal server error.'}), 500
 
+@app.route('/v1/sql/batch', methods=['POST'])
+@auth.login_required
+def user_query_batch():
+    try:
+        payload = request.get_json(silent=True)
+        if payload is not None:
+            questions = payload.get('questions') or []
+            timeout = request_timeout(payload.get('timeout'))
+            answer_mode = answer_mode_option(payload.get('answer_mode'))
+        else:
+            questions = request.form.getlist("user_query")
+            timeout = request_timeout(request.form.get("timeout"))
+            answer_mode = answer_mode_option(request.form.get("answer_mode"))
+        if not questions or not isinstance(questions, list) or not all(isinstance(q, str) and q.strip() for q in questions):
+            logger.warning("Batch questions not provided.")
+            return jsonify({'message': 'Please provide a non-empty list of questions.'}), 400
+        if len(questions) > MAX_BATCH_SIZE:
+            return jsonify({'message': f'A batch can contain at most {MAX_BATCH_SIZE} questions.'}), 400
+
+        started = time.perf_counter()
+        distinct = OrderedDict()
+        for question in questions:
+            distinct.setdefault(normalize_question(question), question)
+        user = auth.current_user()
+        try:
+            rate_limiter.admit(user, len(distinct))
+        except RateLimited as e:
+            logger.warning(f"Rate limiting user {user} on {e.limit} for a batch of {len(distinct)} questions.")
+            return rate_limited_response(e)
+        results = run_batch(list(distinct.values()), time.monotonic() + timeout, answer_mode, user, rate_limiter.weight(user, batch=True))
+        items = [dict(results[distinct[normalize_question(question)]], user_query=question) for question in questions]
+        elapsed = time.perf_counter() - started
+        items_elapsed = sum(results[question]['elapsed'] for question in distinct.values())
+        logger.info(f"Batch of {len(questions)} questions ({len(distinct)} distinct) processed in {elapsed:.3f}s, items took {items_elapsed:.3f}s.")
+        return jsonify({
+            'results': items,
+            'count': len(questions),
+            'distinct': len(distinct),
+            'elapsed': round(elapsed, 3),
+            'items_elapsed': round(items_elapsed, 3),
+        }), 200
+
+    except Exception as e:
+        logger.warning(f"Error processing batch request: {e}")
+        return jsonify({'message': 'Internal server error.'}), 500
+
+@app.route('/v1/sql/export', methods=['POST'])
+@auth.login_required
+def export_query():
+    try:
+        options = request.get_json(silent=True) or request.form
+        user_query = options.get("user_query")
+        cursor = options.get("cursor")
+        if not user_query and not cursor:
+            logger.warning("Export question not provided.")
+            return jsonify({'message': 'Please provide a question in the user_query field or a cursor.'}), 400
+        export_format = (options.get("format") or 'json').lower()
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({'message': f"Format must be one of {', '.join(EXPORT_FORMATS)}."}), 400
+        page_size = export_page_size(options.get("page_size"))
+        timeout = request_timeout(options.get("timeout"))
+        compress = str(options.get("compress") or '').lower()
+        compress = compress == 'gzip' if compress else request.accept_encodings['gzip'] > 0
+
+        user = auth.current_user()
+        try:
+            rate_limiter.admit(user)
+        except RateLimited as e:
+            logger.warning(f"Rate limiting user {user} on {e.limit}.")
+            return rate_limited_response(e)
+
+        if cursor:
+            try:
+                state = decode_cursor(cursor, user)
+            except (InvalidCursor, ValueError, zlib.error) as e:
+                logger.warning(f"Rejected export cursor: {e}")
+                return jsonify({'message': 'Invalid export cursor.'}), 400
+        else:
+            try:
+                future = query_executor.submit(time.monotonic() + timeout, prepare_export, user_query, user=user, weight=rate_limiter.weight(user))
+            except QueryBusy:
+                logger.warning("Query queue is full, rejecting export.")
+                return busy_response()
+            try:
+                state = future.result(timeout=timeout + DEADLINE_GRACE)
+            except DeadlineExceeded as e:
+                logger.warning(f"Export query timed out after {timeout} seconds during {e.stage}.")
+                return jsonify(timeout_body(timeout, e.stage)), 504
+            except FutureTimeoutError:
+                logger.warning(f"Export query timed out after {timeout} seconds.")
+                return jsonify(timeout_body(timeout, 'unknown')), 504
+            except Exception as e:
+                logger.warning(f"Could not build export query: {e}")
+                return jsonify({'message': 'I dont understand your question please provide more details.', 'error': str(e)}), 422
+
+        try:
+            if export_format == 'json':
+                # A JSON body is built in memory, so it never holds more than one page; a query that can't be paged
+                # is cut at page_size and the client is pointed at the streaming formats for the rest.
+                pages = queued_export_page(state, page_size, timeout)
+                columns = next(pages)
+                rows = [[replica_value(value) for value in row] for batch in pages for row in batch]
+                metrics.inc('export_rows_total', len(rows), format=export_format)
+                response = {
+                    'sql': state['sql'],
+                    'columns': columns,
+                    'rows': rows,
+                    'count': len(rows),
+                    'paginated': state['columns'] is not None,
+                    'truncated': state.get('truncated', False),
+                    'next_cursor': None if state.get('done') else encode_cursor(state),
+                }
+                if response['truncated']:
+                    logger.warning(f"Unpaged JSON export stopped at page_size={page_size} rows.")
+                    metrics.inc('export_truncated_total', format=export_format)
+                    response['message'] = "This query can't be paged; request format ndjson or csv to stream every row."
+                return export_response([json.dumps(response)], export_format, compress)
+            chunks = export_rows_chunks(state, export_format, page_size, timeout)
+            # Run the first page's query before answering so SQL errors and timeouts still get a proper status code.
+            first = next(chunks, "")
+        except QueryBusy:
+            logger.warning("Query queue is full, rejecting export.")
+            return busy_response()
+        except DeadlineExceeded as e:
+            logger.warning(f"Export timed out after {timeout} seconds during {e.stage}.")
+            return jsonify(timeout_body(timeout, e.stage)), 504
+        return export_response(itertools.chain([first], chunks), export_format, compress)
+
+    except Exception as e:
+        logger.warning(f"Error processing export request: {e}")
+        return jsonify({'message': 'Internal server error.'}), 500
+
+def require_admin():
+    if auth.current_user() not in ADMIN_USERS:
+        logger.warning(f"User {auth.current_user()} was refused admin access to {request.path}.")
+        return jsonify({'message': 'Admin access required.'}), 403
+    return None
+
+@app.route('/v1/admin/usage', methods=['GET'])
+@auth.login_required
+def admin_usage():
+    denied = require_admin()
+    if denied:
+        return denied
+    usage = rate_limiter.stats()
+    for user, scheduled in query_executor.users().items():
+        usage.setdefault(user, {}).update(scheduled)
+    return jsonify({'users': usage, 'executor': query_executor.stats()}), 200
+
+@app.route('/v1/cache/invalidate', methods=['POST'])
+@auth.login_required
+def invalidate_cache():
+    denied = require_admin()
+    if denied:
+        return denied
+    count = answer_cache.invalidate()
+    logger.info(f"Answer cache invalidated, {count} entries dropped.")
+    response = {'message': 'Cache invalidated.', 'dropped': count}
+    if request.form.get('plans', '').lower() in ('1', 'true', 'yes'):
+        response['plans_dropped'] = plan_store.clear()
+        logger.info(f"SQL plan cache cleared, {response['plans_dropped']} plans dropped.")
+    return jsonify(response), 200
+
+@app.route('/v1/schema/refresh', methods=['POST'])
+@auth.login_required
+def refresh_schema():
+    denied = require_admin()
+    if denied:
+        return denied
+    try:
+        refreshed = schema_snapshot.refresh(force=True)
+        worker_state['schema_generation'] = plan_store.bump('schema')
+        return jsonify({'message': 'Schema snapshot refreshed.', 'refreshed': refreshed, 'snapshot': schema_snapshot.stats()}), 200
+    except Exception as e:
+        logger.warning(f"Error refreshing schema snapshot: {e}")
+        return jsonify({'message': 'Schema snapshot refresh failed.', 'error': str(e)}), 500
+
+@app.route('/v1/stats', methods=['GET'])
+@auth.login_required
+def stats():
+    denied = require_admin()
+    if denied:
+        return denied
+    return jsonify({
+        'answer_cache': answer_cache.stats(),
+        'plan_cache': plan_store.stats(),
+        'executor': query_executor.stats(),
+        'single_flight': in_flight.stats(),
+        'query_checker': query_checker_stats.stats(),
+        'paths': path_stats.stats(),
+        'schema': schema_snapshot.stats(),
+        'entities': entity_index.stats(),
+        'templates': template_library.stats(),
+        'fewshot': few_shot_library.stats(),
+        'replica': replica.stats(),
+        'llm': llm.stats(),
+    }), 200
+
+metrics.gauge('db_pool_size', 'Configured SQL Server connection pool size.', lambda: engine.pool.size())
+metrics.gauge('db_pool_checked_out', 'SQL Server connections currently checked out.', lambda: engine.pool.checkedout())
+metrics.gauge('db_pool_overflow', 'SQL Server overflow connections currently open.', lambda: max(engine.pool.overflow(), 0))
+metrics.gauge('executor_running', 'User queries running on the executor.', lambda: query_executor.stats()['running'])
+metrics.gauge('executor_queued', 'User queries waiting for an executor worker.', lambda: query_executor.stats()['queued'])
+metrics.gauge('executor_rejected_total', 'User queries rejected because the queue was full.', lambda: query_executor.stats()['rejected'], 'counter')
+metrics.gauge('executor_expired_total', 'User queries that expired before a worker picked them up.', lambda: query_executor.stats()['expired'], 'counter')
+metrics.gauge('single_flight_in_flight', 'Distinct user queries currently being answered.', lambda: in_flight.stats()['in_flight'])
+metrics.gauge('single_flight_coalesced_total', 'Requests that joined an identical in-flight query.', lambda: in_flight.stats()['coalesced'], 'counter')
+metrics.gauge('cache_entries', 'Entries held by each cache.', lambda: {
+    (('cache', 'answer'),): answer_cache.stats()['size'],
+    (('cache', 'plan'),): plan_store.stats()['size'],
+})
+metrics.gauge('cache_hits_total', 'Lookups served by each cache.', lambda: {
+    (('cache', 'answer'),): answer_cache.stats()['hits'],
+    (('cache', 'plan'),): plan_store.stats()['hits'],
+    (('cache', 'template'),): template_library.stats()['hits'],
+}, 'counter')
+metrics.gauge('cache_misses_total', 'Lookups missed by each cache.', lambda: {
+    (('cache', 'answer'),): answer_cache.stats()['misses'],
+    (('cache', 'plan'),): plan_store.stats()['misses'],
+}, 'counter')
+
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     logger.info("Starting Flask application.")
-    app.run(debug=True, threaded=True)
+    create_app()
+    init_worker()
+    app.run(debug=app.config['DEBUG'], threaded=True)
 
 
 
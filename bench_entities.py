@@ -0,0 +1,61 @@
+import argparse
+import statistics
+import time
+
+import api2
+
+QUESTIONS = [
+    "who is the manufacturer of the deep fryer",
+    "what is the model number of the ice machine",
+    "list all assets at the main kitchen",
+    "when is the end of life of the walk in cooler",
+]
+
+def like_sql(mentions):
+    predicates = [
+        f"[{column}] LIKE {api2.sql_literal('%' + mention + '%')}"
+        for mention in mentions
+        for column in api2.ENTITY_COLUMNS
+        if column in api2.view_columns()
+    ]
+    return f"SELECT COUNT(*) FROM [{api2.VIEW_NAME}] WHERE " + " OR ".join(predicates)
+
+def resolved_sql(entities):
+    by_column = {}
+    for entity in entities:
+        by_column.setdefault(entity['column'], []).append(entity['value'])
+    predicates = [
+        f"[{column}] IN ({', '.join(api2.sql_literal(value) for value in values)})"
+        for column, values in by_column.items()
+    ]
+    return f"SELECT COUNT(*) FROM [{api2.VIEW_NAME}] WHERE " + " OR ".join(predicates)
+
+def timed(sql, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        _, rows = api2.execute_sql(sql)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), rows[0][0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare LIKE scans against resolved equality/IN predicates on MyAiView.")
+    parser.add_argument("questions", nargs="*", default=QUESTIONS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    api2.entity_index.refresh()
+    print(f"{'question':50} {'resolve ms':>10} {'LIKE ms':>9} {'rows':>6} {'IN ms':>9} {'rows':>6}")
+    for question in args.questions:
+        started = time.perf_counter()
+        entities = api2.entity_index.resolve(question)
+        resolve_ms = (time.perf_counter() - started) * 1000
+        if not entities:
+            print(f"{question[:50]:50} {resolve_ms:10.2f} {'no entities resolved':>32}")
+            continue
+        like_ms, like_rows = timed(like_sql(sorted({entity['mention'] for entity in entities})), args.runs)
+        in_ms, in_rows = timed(resolved_sql(entities), args.runs)
+        print(f"{question[:50]:50} {resolve_ms:10.2f} {like_ms:9.2f} {like_rows:6} {in_ms:9.2f} {in_rows:6}")
+
+if __name__ == '__main__':
+    main()
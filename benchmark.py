@@ -0,0 +1,349 @@
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+ASSETS = [
+    ('Deep Fryer', 'Fryer', 'Antunes'),
+    ('Ice Machine', 'Ice', 'Hoshizaki'),
+    ('Walk-in Cooler', 'Refrigeration', 'Kolpak'),
+    ('Combi Oven', 'Oven', 'Rational'),
+    ('Dish Machine', 'Warewashing', 'Hobart'),
+    ('Reach-in Freezer', 'Refrigeration', 'True'),
+    ('Espresso Machine', 'Beverage', 'La Marzocco'),
+    ('Griddle', 'Cooking', 'Vulcan'),
+]
+LOCATIONS = ['Main Kitchen', 'Bar', 'Bakery', 'Banquet Hall', 'Cafe', 'Loading Dock']
+QUESTIONS = [
+    ("who is the manufacturer of the {asset}", 'Manufacturer'),
+    ("what is the model number of the {asset}", 'Model Number'),
+    ("where is the {asset} located", 'Locations'),
+    ("when is the end of life of the {asset}", 'Endoflife'),
+    ("list all assets at the {location}", 'Assets'),
+]
+
+def build_database(path, rows, seed):
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.execute(
+        'CREATE TABLE "MyAiView" (Assets TEXT, Locations TEXT, CategoryName TEXT, Manufacturer TEXT, '
+        '"ModelNo." TEXT, "Model#" TEXT, "Model Number" TEXT, Endoflife TEXT)'
+    )
+    records = []
+    for number in range(rows):
+        asset, category, manufacturer = ASSETS[number % len(ASSETS)]
+        model = f"{manufacturer[:2].upper()}-{rng.randint(100, 999)}"
+        records.append((
+            f"{asset} {number // len(ASSETS) + 1}", rng.choice(LOCATIONS), category, manufacturer,
+            model, model, model, f"{rng.randint(2024, 2035)}-{rng.randint(1, 12):02d}-01",
+        ))
+    connection.executemany('INSERT INTO "MyAiView" VALUES (?, ?, ?, ?, ?, ?, ?, ?)', records)
+    connection.commit()
+    connection.close()
+    return [record[0] for record in records]
+
+def generate_corpus(assets, distinct, seed):
+    rng = random.Random(seed)
+    questions = []
+    while len(questions) < distinct:
+        pattern, _ = rng.choice(QUESTIONS)
+        question = pattern.format(asset=rng.choice(assets).lower(), location=rng.choice(LOCATIONS).lower())
+        if question not in questions:
+            questions.append(question)
+    return questions
+
+def load_corpus(path, field):
+    questions = []
+    with open(path) as corpus:
+        for line in corpus:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                line = json.loads(line).get(field) or ''
+            if line:
+                questions.append(line)
+    return questions
+
+def fake_llm_class():
+    from langchain_core.language_models.llms import LLM
+    from langchain_core.outputs import Generation, LLMResult
+
+    class BenchmarkLLM(LLM):
+        latency: float = 0.5
+        jitter: float = 0.2
+
+        @property
+        def _llm_type(self):
+            return 'benchmark'
+
+        def _generate(self, prompts, stop=None, run_manager=None, **kwargs):
+            generations = []
+            usage = {'prompt_tokens': 0, 'completion_tokens': 0}
+            for prompt in prompts:
+                text = self._call(prompt, stop=stop)
+                generations.append([Generation(text=text)])
+                usage['prompt_tokens'] += len(prompt) // 4 + 1
+                usage['completion_tokens'] += len(text) // 4 + 1
+            usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+            return LLMResult(generations=generations, llm_output={'token_usage': usage})
+
+        def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+            # Same prompt, same latency: runs stay comparable while still spreading the load.
+            spread = random.Random(zlib.crc32(prompt.encode())).uniform(-self.jitter, self.jitter)
+            time.sleep(max(self.latency * (1 + spread), 0))
+            if 'Double check the' in prompt:
+                return prompt.split('Double check the')[0].strip()
+            if prompt.rstrip().endswith('Corrected SQL query only:'):
+                return 'SELECT DISTINCT [Assets] FROM [MyAiView] LIMIT 10'
+            if prompt.rstrip().endswith('Answer:'):
+                result = prompt.rsplit('SQLResult:', 1)[1].rsplit('Answer:', 1)[0].strip()
+                return f"The answer is {result[:200]}"
+            return self.sql_for(prompt.rsplit('The question:', 1)[-1].split('\n')[0].strip().lower())
+
+        def sql_for(self, question):
+            column = next((column for pattern, column in QUESTIONS if pattern.split('{')[0].strip() in question), 'Assets')
+            location = next((location for location in LOCATIONS if location.lower() in question), None)
+            if location and column == 'Assets':
+                return f"SELECT DISTINCT [Assets] FROM [MyAiView] WHERE [Locations] = '{location}' LIMIT 10"
+            asset = re.sub(r"^.*\bthe\s+|\s+located$", "", question).strip()
+            return f"SELECT DISTINCT [{column}] FROM [MyAiView] WHERE [Assets] LIKE '%{asset}%' LIMIT 10"
+
+    return BenchmarkLLM
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+class Sampler:
+    def __init__(self, api2, interval):
+        self.api2 = api2
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            executor = self.api2.query_executor.stats()
+            self.samples.append({
+                'workers_busy': executor['running'],
+                'queued': executor['queued'],
+                'pool_checked_out': self.api2.engine.pool.checkedout(),
+                'in_flight': self.api2.in_flight.stats()['in_flight'],
+            })
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def summary(self):
+        workers = self.api2.QUERY_WORKERS
+        pool_size = self.api2.engine.pool.size()
+        result = {'samples': len(self.samples), 'workers': workers, 'pool_size': pool_size}
+        for key in ('workers_busy', 'queued', 'pool_checked_out', 'in_flight'):
+            values = [sample[key] for sample in self.samples] or [0]
+            result[f"{key}_max"] = max(values)
+            result[f"{key}_avg"] = round(sum(values) / len(values), 2)
+        result['worker_saturation'] = round(result['workers_busy_avg'] / workers, 4) if workers else 0.0
+        result['pool_saturation'] = round(result['pool_checked_out_avg'] / pool_size, 4) if pool_size else 0.0
+        return result
+
+def post(base_url, authorization, question, answer_mode, timeout):
+    body = urllib.parse.urlencode({'user_query': question, 'answer_mode': answer_mode, 'timeout': timeout}).encode()
+    http_request = urllib.request.Request(f"{base_url}/v1/sql", data=body, headers={'Authorization': authorization})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout + 5) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        status = 'error'
+    return status, time.perf_counter() - started
+
+def run_level(api2, base_url, authorization, questions, concurrency, args):
+    if args.cold:
+        api2.answer_cache.invalidate()
+        api2.plan_store.clear()
+    paths_before = api2.path_stats.stats()
+    statuses = {}
+    latencies = []
+    with Sampler(api2, args.sample_interval) as sampler, ThreadPoolExecutor(max_workers=concurrency) as clients:
+        started = time.perf_counter()
+        for status, seconds in clients.map(lambda question: post(base_url, authorization, question, args.answer_mode, args.timeout), questions):
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200:
+                latencies.append(seconds)
+        elapsed = time.perf_counter() - started
+    paths = {
+        path: entry['attempts'] - paths_before.get(path, {}).get('attempts', 0)
+        for path, entry in api2.path_stats.stats().items()
+    }
+    return {
+        'concurrency': concurrency,
+        'requests': len(questions),
+        'statuses': statuses,
+        'error_rate': round(1 - len(latencies) / len(questions), 4),
+        'elapsed': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99': round(percentile(latencies, 0.99) * 1000, 1),
+            'mean': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+            'max': round(max(latencies, default=0) * 1000, 1),
+        },
+        'saturation': sampler.summary(),
+        'paths': {path: count for path, count in paths.items() if count},
+        'llm_backends': api2.llm.stats(),
+        'users': api2.rate_limiter.stats(),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path) as baseline_file:
+        baseline = {run['concurrency']: run for run in json.load(baseline_file)['runs']}
+    regressed = False
+    print(f"\nCompared with {baseline_path}:")
+    for run in results['runs']:
+        before = baseline.get(run['concurrency'])
+        if before is None:
+            continue
+        changes = []
+        for name, current, previous in (
+            ('p50', run['latency_ms']['p50'], before['latency_ms']['p50']),
+            ('p95', run['latency_ms']['p95'], before['latency_ms']['p95']),
+            ('p99', run['latency_ms']['p99'], before['latency_ms']['p99']),
+            ('rps', run['throughput_rps'], before['throughput_rps']),
+        ):
+            change = (current - previous) / previous if previous else 0.0
+            changes.append(f"{name} {change:+.1%}")
+            if name == 'p95' and change > max_regression:
+                regressed = True
+        print(f"  concurrency {run['concurrency']:>4}: " + ", ".join(changes))
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the /v1/sql endpoint offline against a fake LLM and a SQLite MyAiView.")
+    parser.add_argument("--corpus", help="Questions file: plain lines or JSON lines (see --field). Defaults to a generated set.")
+    parser.add_argument("--field", default="question", help="JSON key holding the question in a JSON lines corpus.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests sent per concurrency level.")
+    parser.add_argument("--distinct", type=int, default=50, help="Distinct questions in the generated corpus.")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma separated client concurrency levels.")
+    parser.add_argument("--llm-latency", type=float, default=500, help="Mean fake LLM latency per call in ms.")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="Relative spread of the fake LLM latency.")
+    parser.add_argument("--llm-backends", type=int, default=1, help="Fake LLM backends in the pool.")
+    parser.add_argument("--slow-factor", type=float, default=1.0, help="Latency multiplier for the first backend, to exercise balancing and hedging.")
+    parser.add_argument("--hedge", action="store_true", help="Enable hedged LLM requests.")
+    parser.add_argument("--rows", type=int, default=500, help="Rows in the SQLite stand-in for MyAiView.")
+    parser.add_argument("--answer-mode", default="auto", choices=["auto", "llm", "direct"])
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--cold", action="store_true", help="Clear the answer and plan caches before each level.")
+    parser.add_argument("--sample-interval", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true", help="Keep the service's INFO logs and per-request access logs.")
+    parser.add_argument("--output", help="Results file. Defaults to benchmark_results/<timestamp>.json.")
+    parser.add_argument("--baseline", help="Earlier results file to compare against.")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Allowed p95 increase over the baseline before exiting non-zero.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='rscs-benchmark-')
+    assets = build_database(os.path.join(workdir, 'myaiview.sqlite3'), args.rows, args.seed)
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'myaiview.sqlite3')}",
+        'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'benchmark'),
+        'SCHEMA_SNAPSHOT_PATH': os.path.join(workdir, 'schema_snapshot.json'),
+        'PLAN_CACHE_PATH': os.path.join(workdir, 'sql_plans.sqlite3'),
+        'REPLICA_ENABLED': 'false',
+        'LLM_HEDGING': 'true' if args.hedge else 'false',
+    })
+    # The whole load comes from one user, so per-user limits would measure the limiter rather than the service.
+    for name, value in (('RATE_LIMIT_REQUESTS_PER_MINUTE', '0'), ('RATE_LIMIT_TOKENS_PER_MINUTE', '0'), ('USER_MAX_QUEUED', '100000')):
+        os.environ.setdefault(name, value)
+
+    import api2
+    from loguru import logger
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING", format="{time} {level} {message}")
+    benchmark_llm = fake_llm_class()
+    api2.llm = api2.LLMPool([
+        api2.LLMBackend(f"fake-{position}", benchmark_llm(latency=args.llm_latency / 1000 * (args.slow_factor if position == 0 else 1), jitter=args.llm_jitter))
+        for position in range(args.llm_backends)
+    ])
+    api2.init_worker()
+    api2.entity_index.refresh()
+    server = make_server('127.0.0.1', 0, api2.create_app(), threaded=True, request_handler=WSGIRequestHandler if args.verbose else QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    username, password = next(iter(api2.users.items()))
+    authorization = 'Basic ' + base64.b64encode(f"{username}:{password}".encode()).decode()
+
+    corpus = load_corpus(args.corpus, args.field) if args.corpus else generate_corpus(assets, args.distinct, args.seed)
+    rng = random.Random(args.seed)
+    results = {
+        'benchmark_version': 1,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_commit': git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'corpus_size': len(corpus),
+        'runs': [],
+    }
+    print(f"{'conc':>5} {'reqs':>6} {'ok':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'workers':>8} {'pool':>6} {'queued':>7}")
+    try:
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            questions = [rng.choice(corpus) for _ in range(args.requests)]
+            run = run_level(api2, base_url, authorization, questions, concurrency, args)
+            results['runs'].append(run)
+            saturation = run['saturation']
+            print(
+                f"{concurrency:5} {run['requests']:6} {run['statuses'].get('200', 0):6} {run['throughput_rps']:8.2f} "
+                f"{run['latency_ms']['p50']:9.1f} {run['latency_ms']['p95']:9.1f} {run['latency_ms']['p99']:9.1f} "
+                f"{saturation['worker_saturation']:8.0%} {saturation['pool_saturation']:6.0%} {saturation['queued_max']:7}"
+            )
+    finally:
+        server.shutdown()
+
+    output = args.output or os.path.join('benchmark_results', f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.baseline and compare(results, args.baseline, args.max_regression):
+        raise SystemExit(f"p95 latency regressed by more than {args.max_regression:.0%} against {args.baseline}.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = 'gthread'
+# Request threads mostly wait on the query executor, so allow enough to keep its workers and queue busy.
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '130'))
+keepalive = 5
+preload_app = True
+wsgi_app = 'api2:create_app()'
+# api2 splits DB_MAX_CONNECTIONS across workers using WEB_CONCURRENCY, so keep it in step with the worker count.
+raw_env = [f"WEB_CONCURRENCY={workers}"]
+
+def post_fork(server, worker):
+    import api2
+    api2.init_worker()
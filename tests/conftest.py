@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmark import build_database
+
+# api2 builds its engine, schema snapshot and caches at import, so point it at a throwaway SQLite MyAiView first.
+workdir = tempfile.mkdtemp(prefix='rscs-tests-')
+build_database(os.path.join(workdir, 'myaiview.sqlite3'), 200, 7)
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'myaiview.sqlite3')}",
+    'OPENAI_API_KEY': 'test',
+    'SCHEMA_SNAPSHOT_PATH': os.path.join(workdir, 'schema_snapshot.json'),
+    'PLAN_CACHE_PATH': os.path.join(workdir, 'sql_plans.sqlite3'),
+    'REPLICA_ENABLED': 'false',
+    'REPLICA_PATH': os.path.join(workdir, 'myaiview_replica.sqlite3'),
+})
+
+import pytest
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    # benchmark.py's deterministic LLM, without its latency, on a fresh pool and fresh path stats.
+    import api2
+    from benchmark import fake_llm_class
+    client = fake_llm_class()(latency=0.0, jitter=0.0)
+    monkeypatch.setattr(api2, 'llm', api2.LLMPool([api2.LLMBackend('fake', client)]))
+    monkeypatch.setattr(api2, 'path_stats', api2.PathStats())
+    monkeypatch.setattr(api2, 'TEMPLATE_FAST_PATH', False)
+    return client
@@ -0,0 +1,70 @@
+import base64
+import threading
+
+import pytest
+
+import api2
+
+HEADERS = {'Authorization': 'Basic ' + base64.b64encode(b"john doe:john@12345").decode()}
+
+@pytest.fixture
+def submitted(monkeypatch):
+    # Every question answers itself in upper case after a short delay, unless a test scripts something else for it.
+    monkeypatch.setattr(api2, 'rate_limiter', api2.RateLimiter())
+    monkeypatch.setattr(api2, 'BATCH_PARALLELISM', 4)
+    calls = []
+    scripted = {}
+
+    def submit_user_query(question, deadline, answer_mode='auto', user=None, weight=1.0):
+        calls.append(question)
+        if question in scripted:
+            return scripted[question]()
+        future = api2.Future()
+        threading.Timer(0.1, future.set_result, [{'response': question.upper()}]).start()
+        return future
+
+    monkeypatch.setattr(api2, 'submit_user_query', submit_user_query)
+    return calls, scripted
+
+def post_batch(questions):
+    return api2.app.test_client().post('/v1/sql/batch', json={'questions': questions}, headers=HEADERS)
+
+def test_batch_runs_each_distinct_question_once_and_keeps_input_order(submitted):
+    calls, _ = submitted
+    body = post_batch(["who makes the oven 1", "list assets at the bar", "Who makes the Oven 1?"]).get_json()
+    assert calls == ["who makes the oven 1", "list assets at the bar"]
+    assert (body['count'], body['distinct']) == (3, 2)
+    assert [item['user_query'] for item in body['results']] == ["who makes the oven 1", "list assets at the bar", "Who makes the Oven 1?"]
+    assert [item['response'] for item in body['results']] == ["WHO MAKES THE OVEN 1", "LIST ASSETS AT THE BAR", "WHO MAKES THE OVEN 1"]
+
+def test_batch_items_run_in_parallel(submitted):
+    body = post_batch(["q one", "q two", "q three"]).get_json()
+    assert body['items_elapsed'] >= 0.3
+    assert body['elapsed'] < body['items_elapsed']
+    assert all(item['elapsed'] >= 0.1 for item in body['results'])
+
+def test_batch_reports_failures_per_item(submitted):
+    _, scripted = submitted
+
+    def busy():
+        raise api2.QueryBusy()
+
+    def timed_out():
+        future = api2.Future()
+        future.set_exception(api2.DeadlineExceeded('generate'))
+        return future
+
+    scripted["busy question"] = busy
+    scripted["slow question"] = timed_out
+    response = post_batch(["busy question", "fine question", "slow question"])
+    assert response.status_code == 200
+    busy_item, fine_item, slow_item = response.get_json()['results']
+    assert busy_item['error'] == 'busy' and busy_item['elapsed'] == 0.0
+    assert fine_item['response'] == "FINE QUESTION"
+    assert (slow_item['error'], slow_item['stage']) == ('timeout', 'generate')
+
+def test_batch_rejects_bad_input(submitted, monkeypatch):
+    monkeypatch.setattr(api2, 'MAX_BATCH_SIZE', 2)
+    assert post_batch([]).status_code == 400
+    assert post_batch(["a", " "]).status_code == 400
+    assert post_batch(["a", "b", "c"]).status_code == 400
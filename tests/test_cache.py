@@ -0,0 +1,29 @@
+import api2
+
+def test_normalize_question_drops_filler_and_punctuation():
+    assert api2.normalize_question("Who is the manufacturer of the Deep Fryer?") == "manufacturer deep fryer"
+    assert api2.normalize_question("  who IS the   manufacturer of the deep fryer ") == "manufacturer deep fryer"
+
+def test_normalize_question_keeps_model_identifiers():
+    assert api2.normalize_question("what is the Model# of the ice machine") == "model# ice machine"
+    assert api2.normalize_question("what is the ModelNo. of KM-515.") == "modelno km 515"
+
+def test_normalize_question_keeps_distinct_questions_apart():
+    assert api2.normalize_question("list all assets at the bar") != api2.normalize_question("list all assets at the bakery")
+
+def test_invalidation_reaches_caches_in_other_workers():
+    # Two caches over the same plan store file stand in for two gunicorn workers.
+    first = api2.AnswerCache(16, 60)
+    second = api2.AnswerCache(16, 60)
+    first.put('manufacturer deep fryer', 'Antunes', 1.0, 100)
+    second.put('manufacturer deep fryer', 'Antunes', 1.0, 100)
+    assert second.get('manufacturer deep fryer') == 'Antunes'
+    first.invalidate()
+    assert first.get('manufacturer deep fryer') is None
+    assert second.get('manufacturer deep fryer') is None
+
+def test_cache_survives_lookups_without_invalidation():
+    cache = api2.AnswerCache(16, 60)
+    cache.put('model# ice machine', 'KM-515', 1.0, 100)
+    assert cache.get('model# ice machine') == 'KM-515'
+    assert cache.get('model# ice machine') == 'KM-515'
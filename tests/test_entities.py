@@ -0,0 +1,55 @@
+import pytest
+
+import api2
+
+@pytest.fixture
+def index(monkeypatch):
+    index = api2.EntityIndex()
+    index.load([('Assets', f"Deep Fryer {number}") for number in range(1, 40)] + [
+        ('CategoryName', 'Fryer'), ('Manufacturer', 'True'), ('Manufacturer', 'Antunes'), ('Locations', 'Bar'), ('Locations', 'Main Kitchen'),
+    ])
+    monkeypatch.setattr(api2, 'entity_index', index)
+    return index
+
+def test_mention_keeps_every_value_over_the_threshold(index):
+    entities = index.resolve("who is the manufacturer of the deep fryer")
+    values = {entity['value'] for entity in entities if entity['mention'] == 'deep fryer'}
+    assert {'Deep Fryer 1', 'Deep Fryer 10', 'Deep Fryer 39'} <= values
+    assert all(entity['ambiguous'] for entity in entities if entity['mention'] == 'deep fryer')
+
+def test_exact_value_settles_the_mention(index):
+    entities = index.resolve("who is the manufacturer of deep fryer 12")
+    assert [(entity['column'], entity['value'], entity['ambiguous']) for entity in entities] == [('Assets', 'Deep Fryer 12', False)]
+
+def test_common_words_are_not_entities(index):
+    entities = index.resolve("is it true that the bar has a deep fryer 3")
+    assert ('Manufacturer', 'True') not in {(entity['column'], entity['value']) for entity in entities}
+    assert ('Locations', 'Bar') in {(entity['column'], entity['value']) for entity in entities}
+
+def test_hint_keeps_like_for_ambiguous_mentions(index):
+    hint = api2.entity_hint("who is the manufacturer of the deep fryer")
+    assert "[Assets] LIKE '%deep fryer%'" in hint
+    assert "= 'Deep Fryer 1'" not in hint and "IN (" not in hint
+
+def test_hint_uses_exact_values_when_unambiguous(index):
+    hint = api2.entity_hint("list all assets at the main kitchen made by antunes")
+    assert "- [Locations] = 'Main Kitchen'" in hint
+    assert "- [Manufacturer] = 'Antunes'" in hint
+    assert "LIKE" not in hint.split("instead of LIKE")[1]
+
+def test_resolve_reuses_the_result_for_the_same_question(index, monkeypatch):
+    first = index.resolve("who is the manufacturer of the deep fryer 12")
+    monkeypatch.setattr(index, 'resolve_text', lambda text, snapshot: pytest.fail("resolved twice"))
+    assert index.resolve("Who is the manufacturer of the Deep Fryer 12?") is first
+
+def test_refresh_swaps_in_a_new_index(index):
+    assert index.resolve("list assets at the bar")
+    added, removed = index.load([('Locations', 'Patio')])
+    assert (added, removed) == (1, 44)
+    assert index.resolve("list assets at the bar") == []
+    assert index.stats()['values'] == 1
+
+def test_hint_is_capped(index, monkeypatch):
+    monkeypatch.setattr(api2, 'ENTITY_HINT_MAX_LINES', 1)
+    hint = api2.entity_hint("list all assets at the main kitchen made by antunes")
+    assert len([line for line in hint.splitlines() if line.startswith("- ")]) == 1
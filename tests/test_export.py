@@ -0,0 +1,119 @@
+import base64
+import collections
+import json
+
+import pytest
+
+import api2
+
+HEADERS = {'Authorization': 'Basic ' + base64.b64encode(b"john doe:john@12345").decode()}
+
+def view_rows(sql):
+    with api2.engine.connect() as connection:
+        return collections.Counter(tuple(row) for row in api2.execute_statement(connection, sql, {}))
+
+def export_state(sql, columns):
+    return {'user': 'john doe', 'sql': sql, 'parameters': {}, 'columns': columns, 'after': None, 'skip': 0}
+
+def cache_plan(question, sql):
+    api2.plan_store.put(api2.normalize_question(question), question, sql)
+
+@pytest.fixture
+def unwrappable(monkeypatch):
+    # SQL Server refuses to wrap some statements SQLite accepts, which leaves them to be exported unpaged.
+    def run_statement(target_engine, sql, parameters=None):
+        if sql.startswith("SELECT * FROM ("):
+            raise api2.SQLAlchemyError("The ORDER BY clause is invalid in derived tables.")
+        return original(target_engine, sql, parameters)
+    original = api2.run_statement
+    monkeypatch.setattr(api2, 'run_statement', run_statement)
+    cache_plan("export every asset", "SELECT [Assets] FROM [MyAiView] ORDER BY LOWER([Assets]) LIMIT 10")
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT DISTINCT TOP (5) [Assets] FROM [MyAiView] WHERE [Assets] = N'top 5' ORDER BY [Assets] OFFSET 0 ROWS FETCH NEXT 5 ROWS ONLY",
+     "SELECT DISTINCT [Assets] FROM [MyAiView] WHERE [Assets] = N'top 5'"),
+    ("SELECT TOP 10 [Locations], COUNT(*) AS [Total] FROM [MyAiView] GROUP BY [Locations] ORDER BY COUNT(*) DESC",
+     "SELECT [Locations], COUNT(*) AS [Total] FROM [MyAiView] GROUP BY [Locations]"),
+    ("SELECT [Assets] FROM [MyAiView] WHERE [Endoflife] = (SELECT MAX([Endoflife]) FROM [MyAiView]) ORDER BY [Assets] LIMIT 10",
+     "SELECT [Assets] FROM [MyAiView] WHERE [Endoflife] = (SELECT MAX([Endoflife]) FROM [MyAiView])"),
+])
+def test_strip_row_limits(sql, expected):
+    assert api2.strip_row_limits(sql) == expected
+
+def test_strip_row_limits_can_keep_the_order():
+    sql = "SELECT TOP 10 [Assets] FROM [MyAiView] ORDER BY LOWER([Assets])"
+    assert api2.strip_row_limits(sql, keep_order=True) == "SELECT [Assets] FROM [MyAiView] ORDER BY LOWER([Assets])"
+
+@pytest.mark.parametrize('sql', [
+    "SELECT TOP 5 PERCENT [Assets] FROM [MyAiView]",
+    "SELECT [Assets] FROM [MyAiView] WHERE [Assets] IN (SELECT TOP 3 [Assets] FROM [MyAiView] ORDER BY [Endoflife])",
+])
+def test_strip_row_limits_refuses_limits_it_cannot_drop(sql):
+    assert api2.strip_row_limits(sql) is None
+
+def test_keyset_predicate():
+    predicate = api2.keyset_predicate(['Assets', 'Locations'], ["'Oven 1'", None], False)
+    assert predicate == "([Assets] > 'Oven 1') OR ([Assets] = 'Oven 1' AND 1 = 1)"
+    predicate = api2.keyset_predicate(['Assets', 'Locations'], [None, "'Bar'"], False)
+    assert predicate == "([Assets] IS NOT NULL) OR ([Assets] IS NULL AND [Locations] >= 'Bar')"
+
+def test_keyset_predicate_escapes_bind_colons():
+    assert api2.keyset_predicate(['Assets'], ["'a:b'"], True) == "([Assets] >= 'a\\:b')"
+
+def test_export_pages_cover_duplicate_rows():
+    sql = "SELECT [Locations], [CategoryName] FROM [MyAiView]"
+    state = export_state(sql, ['Locations', 'CategoryName'])
+    got = collections.Counter()
+    while not state.get('done'):
+        pages = api2.export_page(state, 7, 10)
+        next(pages)
+        got.update(tuple(row) for batch in pages for row in batch)
+        state = json.loads(json.dumps(state))
+    assert got == view_rows(sql)
+
+def test_unpaged_export_page_reports_the_cutoff():
+    state = export_state("SELECT [Assets] FROM [MyAiView]", None)
+    pages = api2.export_page(state, 50, 10)
+    next(pages)
+    assert sum(len(batch) for batch in pages) == 50
+    assert state['done'] and state['truncated']
+    state = export_state("SELECT [Assets] FROM [MyAiView]", None)
+    pages = api2.export_page(state, 1000, 10)
+    next(pages)
+    assert sum(len(batch) for batch in pages) == 200
+    assert state['done'] and not state['truncated']
+
+def test_unpaged_export_drops_the_row_limit(unwrappable):
+    client = api2.app.test_client()
+    body = client.post('/v1/sql/export', json={'user_query': 'export every asset', 'page_size': 500}, headers=HEADERS).get_json()
+    assert body['sql'] == "SELECT [Assets] FROM [MyAiView] ORDER BY LOWER([Assets])"
+    assert not body['paginated'] and not body['truncated'] and body['next_cursor'] is None
+    assert body['count'] == 200
+
+def test_unpaged_json_export_holds_one_page(unwrappable):
+    client = api2.app.test_client()
+    body = client.post('/v1/sql/export', json={'user_query': 'export every asset', 'page_size': 5}, headers=HEADERS).get_json()
+    assert body['count'] == 5 and body['truncated'] and body['next_cursor'] is None
+    assert 'ndjson' in body['message']
+
+def test_unpaged_ndjson_export_streams_every_row(unwrappable):
+    client = api2.app.test_client()
+    response = client.post('/v1/sql/export', json={'user_query': 'export every asset', 'format': 'ndjson', 'page_size': 5, 'compress': 'none'}, headers=HEADERS)
+    assert len(response.data.decode().splitlines()) == 200
+
+def test_unpaged_ndjson_export_streams_to_the_row_cap(monkeypatch, unwrappable):
+    monkeypatch.setattr(api2, 'EXPORT_MAX_ROWS', 30)
+    client = api2.app.test_client()
+    response = client.post('/v1/sql/export', json={'user_query': 'export every asset', 'format': 'ndjson', 'page_size': 5, 'compress': 'none'}, headers=HEADERS)
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert len(lines) == 31
+    assert lines[-1] == {'truncated': True, 'count': 30, 'next_cursor': None}
+
+def test_export_is_refused_when_the_query_queue_is_full(monkeypatch):
+    def busy(*args, **kwargs):
+        raise api2.QueryBusy()
+    cache_plan("export all locations", "SELECT [Locations] FROM [MyAiView]")
+    state = api2.app.test_client().post('/v1/sql/export', json={'user_query': 'export all locations', 'page_size': 5}, headers=HEADERS).get_json()
+    monkeypatch.setattr(api2.query_executor, 'submit', busy)
+    response = api2.app.test_client().post('/v1/sql/export', json={'cursor': state['next_cursor']}, headers=HEADERS)
+    assert response.status_code == 503
@@ -0,0 +1,61 @@
+import json
+import re
+
+import pytest
+
+import api2
+
+EXAMPLES = [
+    ("what is the manufacturer of the deep fryer", "SELECT DISTINCT [Manufacturer] FROM [MyAiView] WHERE [Assets] LIKE '%Deep Fryer%'"),
+    ("who makes the ice machine", "SELECT DISTINCT [Manufacturer] FROM [MyAiView] WHERE [Assets] LIKE '%Ice Machine%'"),
+    ("list the assets at the main kitchen", "SELECT DISTINCT [Assets] FROM [MyAiView] WHERE [Locations] = 'Main Kitchen'"),
+    ("when is the end of life of the walk in cooler 3", "SELECT DISTINCT [Endoflife] FROM [MyAiView] WHERE [Assets] = 'Walk In Cooler 3'"),
+]
+
+@pytest.fixture
+def library():
+    library = api2.FewShotLibrary(None)
+    for question, sql in EXAMPLES:
+        library.add(question, sql)
+    return library
+
+def test_select_ranks_similar_questions_first(library):
+    selected = library.select("what is the manufacturer of the ice machine 2")
+    assert [question for question, _ in selected] == ["who makes the ice machine", "what is the manufacturer of the deep fryer"]
+
+def test_select_skips_the_question_itself(library):
+    selected = library.select("List the assets at the Main Kitchen?")
+    assert "list the assets at the main kitchen" not in [question for question, _ in selected]
+
+def test_select_stays_within_k_and_the_token_budget(library, monkeypatch):
+    monkeypatch.setattr(api2, 'FEWSHOT_MIN_SIMILARITY', 0.0)
+    monkeypatch.setattr(api2, 'FEWSHOT_K', 2)
+    assert len(library.select("what is the manufacturer of the oven")) == 2
+    cost = api2.estimate_tokens(EXAMPLES[0][0]) + api2.estimate_tokens(EXAMPLES[0][1])
+    monkeypatch.setattr(api2, 'FEWSHOT_TOKEN_BUDGET', cost)
+    assert len(library.select("what is the manufacturer of the deep fryer 2")) == 1
+
+def test_prompt_falls_back_to_the_static_example(library, monkeypatch):
+    prompt, mode = library.prompt("what is the manufacturer of the deep fryer 2", "boom")
+    assert mode == 'dynamic' and "[Assets] LIKE '%Deep Fryer%'" in prompt and "The error: boom" in prompt
+    assert library.prompt("zzzz qqqq", "boom")[1] == 'static'
+    monkeypatch.setattr(api2, 'FEWSHOT_MODE', 'static')
+    assert library.prompt("what is the manufacturer of the deep fryer 2", "boom") == (api2.PROMPT1.format(question="what is the manufacturer of the deep fryer 2", error="boom"), 'static')
+
+def test_record_reports_each_mode(library):
+    library.record('dynamic', "x" * 400, True)
+    library.record('dynamic', "x" * 800, False)
+    library.record('static', "x" * 400, True)
+    by_mode = library.stats()['by_mode']
+    assert by_mode['dynamic'] == {'calls': 2, 'success_rate': 0.5, 'avg_prompt_tokens': 151.0}
+    assert by_mode['static']['calls'] == 1
+
+def test_seed_examples_are_valid_and_follow_the_entity_hint_rules():
+    with open(api2.FEWSHOT_EXAMPLES_PATH) as examples_file:
+        examples = [json.loads(line) for line in examples_file if line.strip()]
+    assert examples
+    for example in examples:
+        api2.validate_sql(example['sql'])
+        # Assets are numbered ("Deep Fryer 1..39"), so a bare asset name is a LIKE filter and only a numbered one is exact.
+        for value in re.findall(r"\[Assets\] = '([^']*)'", example['sql']):
+            assert re.search(r"\d$", value)
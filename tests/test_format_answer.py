@@ -0,0 +1,24 @@
+import api2
+
+def test_single_value_uses_the_column_name():
+    assert api2.format_answer("SELECT [Manufacturer] FROM [MyAiView] LIMIT 1", ['Manufacturer'], [('Antunes',)]) == "The Manufacturer is Antunes."
+
+def test_unaliased_aggregate_reads_as_result():
+    assert api2.format_answer("SELECT COUNT(*) FROM [MyAiView]", [''], [(7,)]) == "The result is 7."
+    assert api2.format_answer("SELECT COUNT(*) FROM [MyAiView]", ['COUNT(*)'], [(7,)]) == "The result is 7."
+
+def test_unaliased_columns_in_wider_results_go_to_the_llm():
+    assert api2.format_answer("SELECT [Locations], COUNT(*) FROM [MyAiView] GROUP BY [Locations]", ['Locations', ''], [('Bar', 3)]) is None
+    assert api2.format_answer("SELECT [Locations], COUNT(*) FROM [MyAiView] GROUP BY [Locations]", ['Locations', ''], [('Bar', 3)], complete=True) == "Locations: Bar; column 2: 3."
+
+def test_requested_top_is_not_reported_as_truncated():
+    answer = api2.format_answer("SELECT TOP 1 [Assets] FROM [MyAiView] ORDER BY [Endoflife]", ['Assets'], [('Griddle 3',)])
+    assert answer == "The Assets is Griddle 3."
+
+def test_default_limit_is_reported_as_truncated():
+    rows = [(f"Griddle {number}",) for number in range(api2.db_chain.top_k)]
+    answer = api2.format_answer(f"SELECT [Assets] FROM [MyAiView] LIMIT {api2.db_chain.top_k}", ['Assets'], rows)
+    assert answer.endswith(f"Only the first {len(rows)} records are shown; more may be available.")
+
+def test_empty_result():
+    assert api2.format_answer("SELECT [Assets] FROM [MyAiView] LIMIT 10", ['Assets'], [(None,)]) == api2.EMPTY_ANSWER
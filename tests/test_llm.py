@@ -0,0 +1,79 @@
+import time
+
+import httpx
+import openai
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_openai import AzureChatOpenAI, AzureOpenAI, ChatOpenAI, OpenAI
+
+import api2
+
+AZURE = {'type': 'azure', 'deployment': 'gpt-35', 'endpoint': 'https://example.openai.azure.com', 'api_key': 'test', 'api_version': '2024-02-01'}
+
+def test_azure_deployments_use_the_chat_api_by_default():
+    client = api2.llm_client(AZURE, 0)
+    assert isinstance(client, AzureChatOpenAI)
+    assert client.deployment_name == 'gpt-35'
+
+def test_azure_completion_deployments_can_be_configured():
+    assert isinstance(api2.llm_client(dict(AZURE, kind='completion'), 0), AzureOpenAI)
+
+def test_openai_backends_keep_the_completions_api_unless_asked():
+    assert isinstance(api2.llm_client({'type': 'openai'}, 0), OpenAI)
+    assert isinstance(api2.llm_client({'type': 'openai', 'kind': 'chat', 'model': 'gpt-4o-mini'}, 0), ChatOpenAI)
+
+def test_llm_text_reads_chat_messages():
+    assert api2.llm_text("SELECT 1") == "SELECT 1"
+    assert api2.llm_text(AIMessage(content="SELECT 1")) == "SELECT 1"
+
+class FlakyClient:
+    def __init__(self, failures, delay=0.0):
+        self.failures = failures
+        self.delay = delay
+        self.timeouts = []
+
+    def invoke(self, prompt, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        if self.failures:
+            self.failures -= 1
+            time.sleep(self.delay if timeout is None else min(self.delay, timeout))
+            raise openai.APITimeoutError(request=httpx.Request('POST', 'https://api.openai.com/v1/completions'))
+        return "SELECT 1"
+
+@pytest.fixture
+def deadline():
+    def set_deadline(seconds):
+        tokens.append(api2.request_deadline.set(time.monotonic() + seconds))
+    tokens = []
+    yield set_deadline
+    for token in reversed(tokens):
+        api2.request_deadline.reset(token)
+
+def test_clients_leave_retries_to_the_pool():
+    assert all(backend.client.max_retries == 0 for backend in api2.llm.backends)
+
+def test_pool_retries_a_single_backend(monkeypatch):
+    monkeypatch.setattr(api2, 'LLM_MAX_RETRIES', 2)
+    monkeypatch.setattr(api2, 'LLM_RETRY_BACKOFF', 0.0)
+    client = FlakyClient(failures=2)
+    assert api2.LLMPool([api2.LLMBackend('flaky', client)]).invoke("question") == "SELECT 1"
+    assert len(client.timeouts) == 3
+
+def test_pool_gives_up_after_the_retry_budget(monkeypatch):
+    monkeypatch.setattr(api2, 'LLM_MAX_RETRIES', 1)
+    monkeypatch.setattr(api2, 'LLM_RETRY_BACKOFF', 0.0)
+    client = FlakyClient(failures=5)
+    with pytest.raises(openai.APITimeoutError):
+        api2.LLMPool([api2.LLMBackend('flaky', client)]).invoke("question")
+    assert len(client.timeouts) == 2
+
+def test_retries_stay_inside_the_request_deadline(monkeypatch, deadline):
+    monkeypatch.setattr(api2, 'LLM_MAX_RETRIES', 2)
+    monkeypatch.setattr(api2, 'LLM_RETRY_BACKOFF', 0.05)
+    client = FlakyClient(failures=5, delay=1.0)
+    deadline(0.3)
+    started = time.monotonic()
+    with pytest.raises(api2.DeadlineExceeded):
+        api2.LLMPool([api2.LLMBackend('slow', client)]).invoke("question")
+    assert time.monotonic() - started < 0.5
+    assert len(client.timeouts) == 1 and 0 < client.timeouts[0] <= 0.3
@@ -0,0 +1,82 @@
+import sqlite3
+import time
+
+import pytest
+
+import api2
+
+def locked(*args, **kwargs):
+    raise sqlite3.OperationalError("database is locked")
+
+def test_answer_survives_a_plan_store_that_cannot_be_written(fake_llm, monkeypatch):
+    monkeypatch.setattr(api2.plan_store, 'put', locked)
+    result = api2.process_uncached_query("who is the manufacturer of the deep fryer 1")
+    assert "response" in result
+    stats = api2.path_stats.stats()
+    assert stats['primary']['attempts'] == stats['primary']['successes'] == 1
+    assert 'repair' not in stats and 'fallback' not in stats
+
+def test_plan_store_lookup_failure_falls_through_to_generation(fake_llm, monkeypatch):
+    monkeypatch.setattr(api2.plan_store, 'get', locked)
+    result = api2.process_uncached_query("who is the manufacturer of the deep fryer 2")
+    assert "response" in result
+    assert api2.path_stats.stats()['primary']['successes'] == 1
+
+GOOD_SQL = "SELECT DISTINCT [Manufacturer] FROM [MyAiView] WHERE [Assets] LIKE '%Deep Fryer%' LIMIT 10"
+BAD_SQL = "SELECT DISTINCT [Maker] FROM [MyAiView] LIMIT 10"
+
+class ScriptedLLM:
+    # Answers each kind of prompt from its own script: generation, repair and the PROMPT1 fallback.
+    def __init__(self, generated, repairs=(), fallback=GOOD_SQL, delay=0.0):
+        self.generated = list(generated)
+        self.repairs = list(repairs)
+        self.fallback = fallback
+        self.delay = delay
+        self.repair_prompts = []
+
+    def invoke(self, prompt, **kwargs):
+        time.sleep(self.delay)
+        if prompt.rstrip().endswith('Corrected SQL query only:'):
+            self.repair_prompts.append(prompt)
+            return self.repairs.pop(0)
+        if "The error:" in prompt:
+            return self.fallback
+        return self.generated.pop(0)
+
+@pytest.fixture
+def scripted(fake_llm, monkeypatch):
+    def install(*args, **kwargs):
+        client = ScriptedLLM(*args, **kwargs)
+        monkeypatch.setattr(api2, 'llm', api2.LLMPool([api2.LLMBackend('scripted', client)]))
+        return client
+    return install
+
+def test_repair_fixes_a_failed_query(scripted):
+    client = scripted([BAD_SQL], [GOOD_SQL], delay=0.01)
+    result = api2.process_uncached_query("who built the deep fryer in repair test one")
+    assert "Antunes" in result["response"]
+    assert "Invalid column name 'Maker'" in client.repair_prompts[0]
+    stats = api2.path_stats.stats()
+    assert (stats['primary']['successes'], stats['repair']['attempts'], stats['repair']['successes']) == (0, 1, 1)
+    assert stats['repair']['avg_ms'] >= 10
+    assert 'fallback' not in stats
+    assert api2.plan_store.get(api2.normalize_question("who built the deep fryer in repair test one")) == GOOD_SQL
+
+def test_repair_gives_up_after_its_attempts_and_falls_back(scripted, monkeypatch):
+    monkeypatch.setattr(api2, 'SQL_REPAIR_ATTEMPTS', 2)
+    bad_again = "SELECT DISTINCT [Brand] FROM [MyAiView] LIMIT 10"
+    client = scripted([BAD_SQL], [bad_again, bad_again, GOOD_SQL])
+    result = api2.process_uncached_query("who built the deep fryer in repair test two")
+    assert "Antunes" in result["response"]
+    # Each attempt repairs the previous attempt's query and error, and the third scripted repair is never asked for.
+    assert len(client.repair_prompts) == 2 and "[Brand]" in client.repair_prompts[1]
+    stats = api2.path_stats.stats()
+    assert (stats['repair']['attempts'], stats['repair']['successes']) == (2, 0)
+    assert (stats['fallback']['attempts'], stats['fallback']['successes']) == (1, 1)
+
+def test_repair_can_be_turned_off(scripted, monkeypatch):
+    monkeypatch.setattr(api2, 'SQL_REPAIR_ATTEMPTS', 0)
+    client = scripted([BAD_SQL], [GOOD_SQL])
+    assert "response" in api2.process_uncached_query("who built the deep fryer in repair test three")
+    assert client.repair_prompts == []
+    assert 'repair' not in api2.path_stats.stats()
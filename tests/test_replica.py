@@ -0,0 +1,52 @@
+import sqlite3
+
+import pytest
+
+import api2
+
+ROWS = [
+    ('Deep Fryer 1', 'Main Kitchen', 'Fryer', 'Antunes', 'AN-101', '2022-04-01'),
+    ('Deep Fryer 2', 'Bar', 'Fryer', 'Antunes', 'AN-102', '2031-01-01'),
+    ('Ice Machine 1', 'Bar', 'Ice', 'Hoshizaki', 'KM-515', None),
+    ('Griddle 1', 'Cafe', 'Cooking', 'Vulcan', 'VU-900', '2027-06-01'),
+]
+
+@pytest.fixture(scope='module')
+def replica():
+    # Same shape as LocalReplica's table: untyped NOCASE columns holding replica_value()s.
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE [MyAiView] ([Assets] COLLATE NOCASE, [Locations] COLLATE NOCASE, [CategoryName] COLLATE NOCASE, "
+                       "[Manufacturer] COLLATE NOCASE, [Model#] COLLATE NOCASE, [Endoflife] COLLATE NOCASE)")
+    connection.executemany("INSERT INTO [MyAiView] VALUES (?, ?, ?, ?, ?, ?)", [tuple(map(api2.replica_value, row)) for row in ROWS])
+    yield connection
+    connection.close()
+
+@pytest.mark.parametrize('sql, expected', [
+    ("SELECT TOP 2 [Assets] FROM [dbo].[MyAiView] ORDER BY [Assets]", [('Deep Fryer 1',), ('Deep Fryer 2',)]),
+    ("SELECT [Assets] FROM [MyAiView] ORDER BY [Assets] OFFSET 1 ROWS FETCH NEXT 2 ROWS ONLY", [('Deep Fryer 2',), ('Griddle 1',)]),
+    ("SELECT DISTINCT [Manufacturer] FROM [MyAiView] WHERE [Locations] = N'bar' ORDER BY [Manufacturer]", [('Antunes',), ('Hoshizaki',)]),
+    ("SELECT COUNT(*) FROM [MyAiView] WHERE [Assets] LIKE '%fryer%'", [(2,)]),
+    ("SELECT [Assets] FROM [MyAiView] WHERE ISNULL([Endoflife], 'none') = 'none'", [('Ice Machine 1',)]),
+    ("SELECT [Assets] FROM [MyAiView] WHERE LEN([Model#]) = 6 AND [Manufacturer] = 'O''Brien'", []),
+    ("SELECT [Assets] FROM [MyAiView] WHERE [Endoflife] < '2025-01-01'", [('Deep Fryer 1',)]),
+])
+def test_translation_returns_the_sql_server_rows(replica, sql, expected):
+    translated = api2.translate_tsql(sql)
+    assert translated is not None
+    assert replica.execute(translated).fetchall() == expected
+
+@pytest.mark.parametrize('sql', [
+    "SELECT [Assets] FROM [MyAiView] WHERE CAST([Endoflife] AS DATE) < CAST(GETDATE() AS DATE)",
+    "SELECT [Assets] FROM [MyAiView] WHERE [Model#] LIKE '[A-H]%'",
+    "SELECT [Assets] + ' - ' + [Model#] FROM [MyAiView]",
+    "SELECT CONVERT(varchar, [Endoflife], 101) FROM [MyAiView]",
+    "SELECT [Assets] FROM [MyAiView] WHERE DATEDIFF(day, GETDATE(), [Endoflife]) < 30",
+    "SELECT [Assets] FROM [MyAiView] WHERE CHARINDEX('Fryer', [Assets]) > 0",
+    "SELECT TOP 1 [Assets] FROM [MyAiView] ORDER BY [Assets] OFFSET 0 ROWS",
+])
+def test_statements_with_different_sqlite_meaning_stay_on_sql_server(sql):
+    assert api2.translate_tsql(sql) is None
+
+def test_literals_are_not_rewritten():
+    assert api2.translate_tsql("SELECT [Assets] FROM [MyAiView] WHERE [Assets] = 'a + b [x] CAST(1)'") == \
+        "SELECT [Assets] FROM [MyAiView] WHERE [Assets] = 'a + b [x] CAST(1)'"
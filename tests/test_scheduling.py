@@ -0,0 +1,132 @@
+import base64
+import threading
+import time
+
+import pytest
+
+import api2
+
+def auth_headers(user, password):
+    return {'Authorization': 'Basic ' + base64.b64encode(f"{user}:{password}".encode()).decode()}
+
+def test_token_bucket_waits_for_refill():
+    bucket = api2.TokenBucket(60)
+    assert bucket.wait(60) == 0.0
+    bucket.take(60)
+    assert bucket.wait(1) == pytest.approx(1.0, abs=0.05)
+
+def test_token_bucket_caps_requests_at_capacity():
+    bucket = api2.TokenBucket(60)
+    bucket.take(60)
+    assert bucket.wait(600) == pytest.approx(60.0, abs=0.05)
+
+def test_unlimited_token_bucket_never_waits():
+    bucket = api2.TokenBucket(0)
+    bucket.take(100)
+    assert bucket.wait(100) == 0.0
+
+def test_fair_queue_interleaves_users_by_weight():
+    executor = api2.QueryExecutor(1, 40)
+    order = []
+    gate = threading.Event()
+    deadline = time.monotonic() + 10
+    executor.submit(deadline, gate.wait, user='gate')
+    futures = [executor.submit(deadline, order.append, f'A{i}', user='A', weight=0.25) for i in range(6)]
+    futures += [executor.submit(deadline, order.append, f'B{i}', user='B', weight=1.0) for i in range(2)]
+    gate.set()
+    for future in futures:
+        future.result(timeout=5)
+    # B arrived after all of A's backlog but is not made to wait behind it.
+    assert order[:3] == ['A0', 'B0', 'B1']
+    assert order[3:] == ['A1', 'A2', 'A3', 'A4', 'A5']
+
+def test_fair_queue_limits_queued_jobs_per_user(monkeypatch):
+    monkeypatch.setattr(api2, 'USER_MAX_QUEUED', 2)
+    executor = api2.QueryExecutor(1, 40)
+    gate = threading.Event()
+    deadline = time.monotonic() + 10
+    executor.submit(deadline, gate.wait, user='gate')
+    executor.submit(deadline, time.sleep, 0, user='A')
+    executor.submit(deadline, time.sleep, 0, user='A')
+    with pytest.raises(api2.QueryBusy):
+        executor.submit(deadline, time.sleep, 0, user='A')
+    executor.submit(deadline, time.sleep, 0, user='B')
+    gate.set()
+
+@pytest.mark.parametrize('method, path', [
+    ('get', '/v1/admin/usage'),
+    ('post', '/v1/cache/invalidate'),
+    ('post', '/v1/schema/refresh'),
+    ('get', '/v1/stats'),
+])
+def test_admin_routes_refuse_other_users(method, path):
+    client = api2.app.test_client()
+    response = getattr(client, method)(path, headers=auth_headers('john doe', 'john@12345'))
+    assert response.status_code == 403
+
+def test_admin_routes_allow_admin_users(monkeypatch):
+    monkeypatch.setattr(api2, 'ADMIN_USERS', ['john doe'])
+    client = api2.app.test_client()
+    headers = auth_headers('john doe', 'john@12345')
+    assert client.get('/v1/admin/usage', headers=headers).status_code == 200
+    assert client.post('/v1/cache/invalidate', headers=headers).status_code == 200
+    assert client.get('/v1/stats', headers=headers).status_code == 200
+
+def test_single_flight_shares_one_call_between_concurrent_callers():
+    flight = api2.SingleFlight()
+    started = []
+
+    def start():
+        started.append(api2.Future())
+        return started[-1]
+
+    barrier = threading.Barrier(8)
+    submitted = []
+
+    def caller():
+        barrier.wait()
+        submitted.append(flight.submit('who makes the deep fryer', start))
+
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(started) == 1
+    assert {id(future) for future, _ in submitted} == {id(started[0])}
+    assert sorted(coalesced for _, coalesced in submitted) == [False] + [True] * 7
+    assert flight.stats() == {'in_flight': 1, 'leaders': 1, 'coalesced': 7}
+
+def test_single_flight_hands_errors_to_every_waiter_and_forgets_the_key():
+    flight = api2.SingleFlight()
+    leader, _ = flight.submit('q', api2.Future)
+    follower, coalesced = flight.submit('q', api2.Future)
+    assert coalesced and follower is leader
+    leader.set_exception(ValueError("boom"))
+    for future in (leader, follower):
+        with pytest.raises(ValueError):
+            future.result()
+    assert flight.stats()['in_flight'] == 0
+    again, coalesced = flight.submit('q', api2.Future)
+    assert not coalesced and again is not leader
+
+def test_readyz_does_not_wait_for_a_saturated_pool(monkeypatch):
+    monkeypatch.setattr(api2.engine.pool, 'checkedout', lambda: api2.DB_POOL_SIZE + api2.DB_MAX_OVERFLOW)
+    monkeypatch.setattr(api2, 'probe_database', lambda: pytest.fail("probed a saturated pool"))
+    body = api2.app.test_client().get('/readyz').get_json()
+    assert body['checks']['database'] is True and body['pool']['saturated'] is True
+
+def test_readyz_gives_up_on_a_slow_database(monkeypatch):
+    monkeypatch.setattr(api2, 'READYZ_DB_TIMEOUT', 0.1)
+    monkeypatch.setattr(api2, 'probe_database', lambda: time.sleep(0.5))
+    started = time.monotonic()
+    response = api2.app.test_client().get('/readyz')
+    assert time.monotonic() - started < 0.4
+    assert response.status_code == 503 and response.get_json()['checks']['database'] is False
+
+def test_running_totals_are_exported_as_counters():
+    lines = api2.metrics.render().splitlines()
+    for name in ('executor_rejected_total', 'executor_expired_total', 'single_flight_coalesced_total', 'cache_hits_total', 'cache_misses_total'):
+        assert f"# TYPE {name} counter" in lines
+    assert "# TYPE executor_queued gauge" in lines
+    assert any(line.startswith('cache_hits_total{cache="answer"} ') for line in lines)
@@ -0,0 +1,26 @@
+import pytest
+
+import api2
+
+@pytest.fixture(scope='module', autouse=True)
+def entities():
+    api2.entity_index.refresh()
+
+def test_multi_word_attribute_is_not_split_at_the_first_of():
+    name, sql, parameters = api2.template_library.match("when is the end of life of the deep fryer 1")
+    assert name == 'attribute_of_asset'
+    assert "[Endoflife]" in sql
+    assert parameters == {'asset': 'Deep Fryer 1'}
+
+def test_longest_alias_wins():
+    name, sql, parameters = api2.template_library.match("what is the model number of the ice machine 2?")
+    assert "[ModelNo.], [Model#], [Model Number]" in sql
+    assert parameters == {'asset': 'Ice Machine 2'}
+
+def test_unknown_attribute_falls_through():
+    assert api2.template_library.match("what is the warranty of the deep fryer 1") is None
+
+def test_location_slot_is_bound_as_a_parameter():
+    name, sql, parameters = api2.template_library.match("list all assets at the bar")
+    assert name == 'assets_at_location'
+    assert ":location" in sql and parameters == {'location': 'Bar'}
@@ -0,0 +1,48 @@
+import pytest
+
+import api2
+
+def test_limited_select_on_known_columns_is_safe():
+    assert api2.validate_sql("SELECT DISTINCT [Manufacturer] FROM [MyAiView] WHERE [Assets] = 'Deep Fryer 1' LIMIT 10") is True
+
+def test_unicode_literals_are_not_unknown_words():
+    assert api2.validate_sql("SELECT [Manufacturer] FROM [MyAiView] WHERE [Assets] = N'Deep Fryer 1' LIMIT 10") is True
+
+def test_plain_aggregate_needs_no_limit():
+    assert api2.validate_sql("SELECT COUNT(*) FROM [MyAiView]") is True
+
+def test_aggregate_combined_with_set_operator_needs_the_checker():
+    assert api2.validate_sql("SELECT COUNT(*) FROM [MyAiView] UNION SELECT [Assets] FROM [MyAiView]") is False
+    assert api2.validate_sql("SELECT COUNT(*) FROM [MyAiView] EXCEPT SELECT [Assets] FROM [MyAiView]") is False
+
+def test_grouped_aggregate_needs_a_limit():
+    assert api2.validate_sql("SELECT COUNT(*) FROM [MyAiView] GROUP BY [Locations]") is False
+
+@pytest.mark.parametrize('sql', [
+    "DELETE FROM [MyAiView]",
+    "SELECT [Assets] FROM [MyAiView]; DROP TABLE [MyAiView]",
+    "SELECT [Assets] FROM [MyAiView] WHERE [Assets] IN (SELECT [Assets] FROM [MyAiView] INTO x) LIMIT 1",
+    "SELECT [Serial] FROM [MyAiView] LIMIT 10",
+])
+def test_unsafe_or_invalid_statements_are_rejected(sql):
+    with pytest.raises(api2.SQLValidationError):
+        api2.validate_sql(sql)
+
+def test_keywords_inside_literals_are_ignored():
+    assert api2.validate_sql("SELECT [Assets] FROM [MyAiView] WHERE [Assets] = 'drop; delete' LIMIT 5") is True
+
+@pytest.mark.parametrize('sql', [
+    "WITH fryers AS (SELECT [Assets], [Locations] FROM [MyAiView] WHERE [Assets] LIKE '%fryer%') SELECT TOP 10 [Assets] FROM fryers",
+    "(SELECT [Assets] FROM [MyAiView] LIMIT 5)",
+])
+def test_ctes_and_parenthesized_selects_go_to_the_checker(sql):
+    assert api2.validate_sql(sql) is False
+
+@pytest.mark.parametrize('sql', [
+    "WITH doomed AS (SELECT [Assets] FROM [MyAiView]) DELETE FROM doomed",
+    "(SELECT [Assets] INTO backup FROM [MyAiView])",
+    "EXEC sp_who",
+])
+def test_ctes_and_parenthesized_statements_that_write_are_rejected(sql):
+    with pytest.raises(api2.SQLValidationError):
+        api2.validate_sql(sql)